@@ -1,64 +1,225 @@
 #!/usr/bin/python3
 import os
-import re
+import sys
+from queue import Queue
+from threading import Event, Thread
 from time import time
 from utils import chunks
 from downloader_helper import (
-    batch_fetcher, _dumper, get_last_verified_batch_number)
+    batch_fetcher, get_last_verified_batch_number, log_transport_stats)
+from shards import (
+    contained_shards, list_shards, partial_shards, shard_batches, shard_name,
+    write_shard)
+from storage import ContractStore, DownloadCheckpoint
+from tx_processor import TxProcessor
 import config as cfg
 
+# With 'stream' the txs of each file are also processed (as 1_processor
+#  does) as soon as it is written, without reading it back:
+#  ENV=cardona ./0_downloader.py stream
+streaming = sys.argv[1:] == ['stream']
+if sys.argv[1:] and not streaming:
+    print("Usage: 0_downloader.py [stream]")
+    sys.exit(1)
+
 output_folder = cfg.TRANSACTIONS_FOLDER
+checkpoint_db = os.path.join(cfg.OUTPUT_FOLDER, cfg.DOWNLOAD_CHECKPOINT_DB)
+batches_per_iter = cfg.DOWNLOAD_BATCHES_PER_ITER
+
+# Seconds spent on each stage: fetch (and queue wait, for the writer) on
+#  the main thread, load (from the checkpoint) and write (encode, compress
+#  and save) on the writer, and process on the processor when streaming
+stage_times = {'fetch': 0, 'queue wait': 0, 'load': 0, 'write': 0}
+if streaming:
+    stage_times['process'] = 0
+
+
+def writer(chunks_queue, process_queue, failed):
+    # Writes the files of the chunks fetched, from the checkpoint, while
+    #  the next chunks are fetched. When streaming, passes their txs to the
+    #  processor once it is done with the files there before. Stops on None
+    _checkpoint = DownloadCheckpoint(checkpoint_db)
+    try:
+        if process_queue is not None:
+            caught_up.wait()
+        while (item := chunks_queue.get()) is not None:
+            start, end, name, full, replaced = item
+            start_time = time()
+            txs = list(_checkpoint.iter_txs(start, end))
+            load_time = time() - start_time
+            _hash = write_shard(txs, output_folder, name)
+            # The batches of a shorter (last) file are kept to extend it.
+            #  The file replaced is removed last, on startup if killed before
+            _checkpoint.shard_written(start, end, full)
+            if replaced:
+                os.remove(os.path.join(output_folder, replaced))
+            write_time = time() - start_time - load_time
+            stage_times['load'] += load_time
+            stage_times['write'] += write_time
+            cfg.linfo(
+                f"Wrote batches from {start} to {end} with {len(txs)} txs | "
+                f"load: {load_time:.2f}s write: {write_time:.2f}s")
+            if process_queue is not None and not failed:
+                process_queue.put((name, txs, replaced, _hash))
+    except Exception as e:
+        cfg.lerror(f"Writer failed: {e}")
+        failed.append(e)
+        # Keeps taking chunks, so the fetcher is never blocked on the queue
+        while chunks_queue.get() is not None:
+            pass
+    finally:
+        _checkpoint.close()
+        if process_queue is not None:
+            process_queue.put(None)
+
+
+def processor_stage(process_queue, failed):
+    # Folds the files not processed yet in the contracts store, then the
+    #  txs of each file written, as they come. Stops on None
+    store = None
+    try:
+        store = ContractStore(
+            os.path.join(cfg.OUTPUT_FOLDER, cfg.CONTRACTS_DB))
+        processor = TxProcessor(store, output_folder)
+        processor.rollback_changed()
+        processor.process_files(existing_files)
+        caught_up.set()
+        while (item := process_queue.get()) is not None:
+            name, txs, replaced, _hash = item
+            start_time = time()
+            if replaced and store.is_processed(replaced):
+                processor.rollback(replaced)
+            processor.process(name, lambda: iter(txs), _hash)
+            stage_times['process'] += time() - start_time
+        processor.finish(cfg.OUTPUT_FOLDER)
+    except Exception as e:
+        cfg.lerror(f"Processor failed: {e}")
+        failed.append(e)
+        caught_up.set()
+        while process_queue.get() is not None:
+            pass
+    finally:
+        if store:
+            store.close()
+
 
 # check if the folder exists
 if not os.path.exists(output_folder):
     os.makedirs(output_folder)
-existing_files = sorted(os.listdir(output_folder))
+
+# Batches already downloaded for the file in progress are not fetched again
+checkpoint = DownloadCheckpoint(checkpoint_db)
+
+# A full last file is kept, a shorter one (the chain tip when it was
+#  downloaded) is extended and replaced once the new one is written
+replaced_file = None
+# The writer writes a file, saves its coverage and then removes the one it
+#  replaced. Killed in between, the file being written or the replaced one
+#  are left behind, and removed here
+for _file in partial_shards(output_folder):
+    cfg.linfo(f"Removing {_file}, not completely written")
+    os.remove(os.path.join(output_folder, _file))
+# Of files with the same batches, the one step 1 processed is kept
+_processed = ()
+_contracts_db = os.path.join(cfg.OUTPUT_FOLDER, cfg.CONTRACTS_DB)
+if os.path.exists(_contracts_db):
+    _store = ContractStore(_contracts_db)
+    _processed = set(_file for _file, *_ in _store.processed_files())
+    _store.close()
+for _file in contained_shards(list_shards(output_folder), _processed):
+    cfg.linfo(f"Removing {_file}, its batches are in another file")
+    os.remove(os.path.join(output_folder, _file))
+existing_files = list_shards(output_folder)
 if existing_files:
-    last_file = existing_files[-1]
-    first_batch = re.search(r"from_batch_(\d+)_to", last_file).group(1)
-    first_batch = int(first_batch)
-    os.remove(os.path.join(output_folder, last_file))
+    first_batch, _last = shard_batches(existing_files[-1])
+    _full = _last - first_batch + 1 >= batches_per_iter
+    # Killed after writing the file, before saving its coverage
+    if checkpoint.covered(first_batch) != _last and \
+            checkpoint.done(first_batch, _last):
+        checkpoint.shard_written(first_batch, _last, _full)
+    if _full:
+        first_batch = _last + 1
+    else:
+        replaced_file = existing_files[-1]
 else:
     first_batch = 0
+if first_batch:
+    checkpoint.clear(0, first_batch - 1)
 
 last_batch = get_last_verified_batch_number()
 
 cfg.linfo(f"Getting batches from {first_batch} to {last_batch}.")
 global_start_time = time()
+errors = []
 batches_ids = list(range(first_batch, last_batch+1))
 
-for chunk_batches_ids in chunks(
-    batches_ids, cfg.DOWNLOAD_BATCHES_PER_ITER
-):
-    start = chunk_batches_ids[0]
-    end = chunk_batches_ids[-1]
-    cfg.linfo(f"Downloading batches from {start} to {end}.")
-    start_time = time()
-    txs = batch_fetcher(chunk_batches_ids)
-    _dumper(txs, output_folder, f"from_batch_{start:010}_to_{end:010}.json")
-    total_time = time() - start_time
-    print(
-        f"Downloaded {end-start+1} batches with {len(txs)} txs "
-        f"in {total_time:.2f} seconds | txs/s: {len(txs)/total_time:.0f}"
-    )
+# Chunks fetched wait here for the writer, at most DOWNLOAD_CHUNKS_AHEAD,
+#  and their txs wait for the processor when streaming
+writer_failed = []
+chunks_queue = Queue(maxsize=max(1, cfg.DOWNLOAD_CHUNKS_AHEAD))
+process_queue = None
+caught_up = Event()
+if streaming:
+    process_queue = Queue(maxsize=max(1, cfg.DOWNLOAD_CHUNKS_AHEAD))
+    processor_thread = Thread(
+        target=processor_stage, args=(process_queue, writer_failed))
+    processor_thread.start()
+writer_thread = Thread(
+    target=writer, args=(chunks_queue, process_queue, writer_failed))
+writer_thread.start()
+
+try:
+    for chunk_batches_ids in chunks(batches_ids, batches_per_iter):
+        start = chunk_batches_ids[0]
+        end = chunk_batches_ids[-1]
+        name = shard_name(start, end)
+        if name == replaced_file:
+            cfg.linfo(f"No new batches after {end}.")
+            break
+        if writer_failed:
+            break
+        _done = checkpoint.done(start, end)
+        _missing = [_id for _id in chunk_batches_ids if _id not in _done]
+        cfg.linfo(
+            f"Downloading batches from {start} to {end}, "
+            f"{len(_missing)} missing.")
+        start_time = time()
+        batch_fetcher(_missing, errors=errors, on_batches=checkpoint.add)
+        fetch_time = time() - start_time
+        stage_times['fetch'] += fetch_time
+        chunks_queue.put((
+            start, end, name, len(chunk_batches_ids) == batches_per_iter,
+            replaced_file
+        ))
+        replaced_file = None
+        stage_times['queue wait'] += time() - start_time - fetch_time
+        print(
+            f"Downloaded {len(_missing)} of {end-start+1} batches "
+            f"in {fetch_time:.2f} seconds | "
+            f"batches/s: {len(_missing)/max(fetch_time, 0.001):.0f}"
+        )
+finally:
+    chunks_queue.put(None)
+    writer_thread.join()
+    if streaming:
+        processor_thread.join()
 
+checkpoint.close()
+if errors:
+    print(
+        f"{len(errors)} batches could not be downloaded, "
+        f"run batch_coverage.py repair")
+log_transport_stats()
 global_total_time = time() - global_start_time
+print(
+    "Stages: " +
+    ' | '.join(f"{k}: {v:.2f}s" for k, v in stage_times.items()))
 print(f"Total time: {global_total_time:.2f} seconds")
+if writer_failed:
+    raise writer_failed[0]
 
 # Files generated on the output folder containing all transactions.
-# Each output file is just an array of txs
-# [
-#     {
-#         // all tx properties here
-#         k: v
-#         receipt: {
-#             // all receipt properties here
-#             k: v
-#         }
-#     },
-#     {
-#         ...
-#     }
-#     ...
-# ]
+# Each output file (from_batch_X_to_Y.ndjson.gz) has a tx per line
+# {"k": v, ..., "receipt": {"k": v, ...}}
+# {...}
 # 5h to get all txs from zkevm mainnet
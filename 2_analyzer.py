@@ -1,88 +1,262 @@
 #!/usr/bin/python3
 import os
+import json
+import multiprocessing
 import config as cfg
 from time import time
-from downloader_helper import objects_retriever, _dumper
+from downloader_helper import _dumper
+from utils import chunks
+from evm_opcodes import count_opcodes, OPCODE_HEX
+from evm_cfg import opcode_reachability, UNREACHABLE
+from storage import ContractStore, TraceCache
+from opcode_index import read_index, write_index
 from config import UNSUPPORTED_OPCODES, CHANGED_OPCODES
 import matplotlib.pyplot as plt
 
 
 output_folder = cfg.OUTPUT_FOLDER
-contracts_file = cfg.CONTRACTS_FILE
+contracts_db = cfg.CONTRACTS_DB
 opcodes_file = cfg.OPCODES_FILE
 conflicts_file = cfg.CONFLICTS_FILE
+conflicts_delta_file = cfg.CONFLICTS_DELTA_FILE
+trace_cache_db = cfg.TRACE_CACHE_DB
+opcode_index_file = cfg.OPCODE_INDEX_FILE
 
 global_start_time = time()
 
 
-def check_runtime(address, runtime):
-    assert runtime, f"Contract {address} has no runtime!"
+def check_runtime(code_hash, runtime):
+    assert runtime, f"Runtime {code_hash} is empty!"
     assert runtime.startswith('0x'), \
-        f"Contract for {address} has invalid runtime!"
+        f"Runtime {code_hash} is invalid!"
     assert (len(runtime) % 2 == 0), \
-        f"Contract for {address} has invalid length!"
+        f"Runtime {code_hash} has invalid length!"
 
-    runtime = runtime[2:]
-    bytes_left = len(runtime) // 2
-    pc = 0
-    opcodes = {}
+    code = bytes.fromhex(runtime[2:])
+    counts = count_opcodes(code)
+    opcodes = {
+        OPCODE_HEX[opcode]: count
+        for opcode, count in enumerate(counts) if count
+    }
+    return opcodes, opcode_reachability(code)
 
-    while bytes_left > 0:
-        opcode = runtime[pc*2:pc*2+2]
-        opcodes[opcode] = opcodes.get(opcode, 0) + 1
-        pc += 1
-        bytes_left -= 1
 
-        is_push = int(opcode, 16) >= 0x60 and int(opcode, 16) <= 0x7f
-        if is_push:
-            push_bytes = int(opcode, 16) - 0x5f
-            if push_bytes > bytes_left:
-                # print(f"Push opcode {opcode} has not enough bytes left!")
-                break
-            pc += push_bytes
-            bytes_left -= push_bytes
+def check_runtimes(runtimes):
+    return [
+        (_code_hash, *check_runtime(_code_hash, runtime))
+        for _code_hash, runtime in runtimes
+    ]
 
-    return opcodes
 
+def analyze_runtimes(runtimes):
+    # Runtimes are scanned by chunks in a pool of processes, results come
+    #  back in the same order as a serial scan
+    if cfg.ANALYZER_PROCESSES <= 1 or \
+            len(runtimes) <= cfg.ANALYZER_RUNTIMES_PER_TASK:
+        return check_runtimes(runtimes)
+
+    # Forked, as this script is not importable from spawned workers
+    with multiprocessing.get_context('fork').Pool(
+        cfg.ANALYZER_PROCESSES
+    ) as pool:
+        return [
+            _result
+            for _results in pool.imap(
+                check_runtimes,
+                chunks(runtimes, cfg.ANALYZER_RUNTIMES_PER_TASK)
+            )
+            for _result in _results
+        ]
+
+
+def get_runtime(_code_hash):
+    # (opcodes, reachability, opcode values) of an analyzed runtime, loaded
+    #  once from the store
+    if _code_hash not in runtimes:
+        opcodes, reachability = store.get_runtime(_code_hash)
+        runtimes[_code_hash] = (
+            opcodes, reachability, [int(opcode, 16) for opcode in opcodes])
+    return runtimes[_code_hash]
 
-contracts = objects_retriever(os.path.join(output_folder, contracts_file))
-contract_call_distr = {}
-opcodes_map = {}
-opcodes_totals = {}
 
-_modified = False
+def unreachable(reachability):
+    # Flagged opcodes a runtime can not reach, its contract is left out of
+    #  their conflicts
+    if not cfg.REACHABILITY_FILTER:
+        return []
+    return [
+        _opcode for _opcode in flagged_opcodes
+        if reachability.get(_opcode) == UNREACHABLE
+    ]
 
 
+def get_runtime_flags(_code_hash):
+    # Flagged opcodes of a runtime that may be reachable, with the txs to
+    #  check: failed ones for unsupported opcodes, successful for changed ones
+    if not _code_hash:
+        return ()
+    if _code_hash not in runtime_flags:
+        opcodes, reachability, _ = get_runtime(_code_hash)
+        _unreachable = unreachable(reachability)
+        runtime_flags[_code_hash] = [
+            (_opcode, _success)
+            for _opcodes, _success in (
+                (UNSUPPORTED_OPCODES, 0), (CHANGED_OPCODES, 1))
+            for _opcode in _opcodes
+            if _opcode in opcodes and _opcode not in _unreachable
+        ]
+    return runtime_flags[_code_hash]
+
+
+store = ContractStore(os.path.join(output_folder, contracts_db))
+flagged_opcodes = UNSUPPORTED_OPCODES + CHANGED_OPCODES
+runtimes = {}
+runtime_flags = {}
+# Filled on full rebuilds only, for the plot below
+contract_call_distr = {}
+
 print(
-    f"Contract count: {len(contracts)}",
+    f"Contract count: {store.count_contracts()}",
     "Total transaction count: ",
-    sum(len(v.get('txs', [])) for v in contracts.values()),
+    store.count_txs(success=True),
     "Total failed transaction count: ",
-    sum(len(v.get('failed_txs', [])) for v in contracts.values())
+    store.count_txs(success=False)
 )
 
-for address, info in contracts.items():
-    _call_count = info.get('tx_count', 0)
-    contract_call_distr[_call_count] = \
-        contract_call_distr.get(_call_count, 0) + 1
-
-    if info.get('opcodes') is None:
-        opcode_map = check_runtime(address, info.get('runtime'))
-        contracts[address]['opcodes'] = opcode_map
-        _modified = True
-
-    # update global opcodes counters
-    for opcode, count in contracts[address]['opcodes'].items():
-        if opcode in opcodes_map:
-            opcodes_totals[opcode] = opcodes_totals.get(opcode, 0) + count
-            opcodes_map[opcode][address] = [count, _call_count]
-        else:
-            opcodes_totals[opcode] = count
-            opcodes_map[opcode] = {address: [count, _call_count]}
-
-if _modified:
-    print("Saving modified contracts (added opcodes).")
-    _dumper(contracts, output_folder, contracts_file)
+# Each unique runtime is analyzed once, contracts share it by code hash
+_added_opcodes = analyze_runtimes(store.missing_opcodes())
+if _added_opcodes:
+    print(f"Saving opcodes of {len(_added_opcodes)} new runtimes.")
+    store.set_opcodes(_added_opcodes)
+del _added_opcodes
+
+# Conflicts are kept in the store, only txs added since the last run are
+#  checked. Settings changing the conflicts start them over
+_signature = json.dumps(
+    [UNSUPPORTED_OPCODES, CHANGED_OPCODES, cfg.REACHABILITY_FILTER])
+_last_seq = store.analyzed_seq(_signature) \
+    if cfg.ANALYZER_INCREMENTAL else None
+if _last_seq is None:
+    print("Checking all txs for conflicts.")
+    store.reset_conflicts()
+    _last_seq = 0
+
+# The opcodes file and index are updated for the contracts changed since
+#  the last run (new ones, new txs, rolled back), as the store keeps the
+#  contracts the analyzer saw. Rebuilt from all contracts if not kept, or
+#  if the files are not there
+_opcodes_filename = os.path.join(output_folder, opcodes_file)
+_index_filename = os.path.join(output_folder, opcode_index_file)
+pruned = store.analyzed_pruned()
+opcodes_map = None
+if pruned is not None and os.path.exists(_index_filename):
+    try:
+        with open(_opcodes_filename) as f:
+            opcodes_map = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Opcodes file not usable ({e}), rebuilding it.")
+
+if opcodes_map is None:
+    print("Saving opcodes and index of all contracts.")
+    # Contracts left out of conflicts as the opcode is unreachable
+    pruned = {_opcode: 0 for _opcode in flagged_opcodes}
+    opcodes_map = {}
+    opcodes_totals = {}
+    # (address, tx_count, opcode values) for the opcode index
+    _index_contracts = []
+    _analyzed = []
+    for _code_hash, opcodes, reachability in store.iter_runtimes():
+        runtimes[_code_hash] = (
+            opcodes, reachability, [int(opcode, 16) for opcode in opcodes])
+    print(f"Unique runtimes: {len(runtimes)}")
+
+    for address, _call_count, _code_hash in store.iter_contracts():
+        contract_call_distr[_call_count] = \
+            contract_call_distr.get(_call_count, 0) + 1
+
+        assert _code_hash, f"Contract {address} has no runtime!"
+        opcodes, reachability, _values = get_runtime(_code_hash)
+        _index_contracts.append((address, _call_count, _values))
+        _analyzed.append((address, _call_count, _code_hash))
+        for _opcode in unreachable(reachability):
+            pruned[_opcode] += 1
+
+        # update global opcodes counters
+        for opcode, count in opcodes.items():
+            if opcode in opcodes_map:
+                opcodes_totals[opcode] = \
+                    opcodes_totals.get(opcode, 0) + count
+                opcodes_map[opcode][address] = [count, _call_count]
+            else:
+                opcodes_totals[opcode] = count
+                opcodes_map[opcode] = {address: [count, _call_count]}
+
+    store.drop_analyzed_contracts()
+    write_index(_index_filename, _index_contracts)
+    del _index_contracts
+    opcodes_map['totals'] = opcodes_totals
+    _dumper(opcodes_map, output_folder, opcodes_file)
+    store.set_analyzed_contracts(_analyzed, pruned, full=True)
+    del _analyzed
+else:
+    _changed = store.changed_contracts()
+    print(f"Contracts changed since the last run: {len(_changed)}")
+    if _changed:
+        opcodes_totals = opcodes_map.pop('totals')
+        _index_contracts = {
+            address: (_call_count, _values)
+            for address, _call_count, _values in read_index(_index_filename)
+        }
+        for address, _call_count, _code_hash, _old_count, _old_hash \
+                in _changed:
+            # _call_count None if gone, _old_count None if new
+            if _call_count is not None:
+                assert _code_hash, f"Contract {address} has no runtime!"
+            _old = get_runtime(_old_hash) if _old_count is not None \
+                else None
+            _new = get_runtime(_code_hash) if _call_count is not None \
+                else None
+            for _runtime, _sign in ((_old, -1), (_new, 1)):
+                if _runtime:
+                    for _opcode in unreachable(_runtime[1]):
+                        pruned[_opcode] += _sign
+
+            # Entries of the contract are taken out and set again
+            for opcode in set(_old[0] if _old else ()) | \
+                    set(_new[0] if _new else ()):
+                _entry = opcodes_map.get(opcode, {}).pop(address, None)
+                if _entry:
+                    opcodes_totals[opcode] -= _entry[0]
+                    if not opcodes_map[opcode]:
+                        del opcodes_map[opcode]
+                        del opcodes_totals[opcode]
+            _index_contracts.pop(address, None)
+            if _new:
+                opcodes, _, _values = _new
+                _index_contracts[address] = (_call_count, _values)
+                for opcode, count in opcodes.items():
+                    opcodes_totals[opcode] = \
+                        opcodes_totals.get(opcode, 0) + count
+                    opcodes_map.setdefault(opcode, {})[address] = \
+                        [count, _call_count]
+
+        store.drop_analyzed_contracts()
+        write_index(_index_filename, [
+            (address, _call_count, _values)
+            for address, (_call_count, _values) in _index_contracts.items()
+        ])
+        del _index_contracts
+        opcodes_map['totals'] = opcodes_totals
+        _dumper(opcodes_map, output_folder, opcodes_file)
+        store.set_analyzed_contracts(
+            (
+                (address, _call_count, _code_hash)
+                for address, _call_count, _code_hash, _, _ in _changed
+            ),
+            pruned)
+    del _changed
+
+del opcodes_map
 
 # print(
 #     "Call distribution:",
@@ -91,32 +265,46 @@ if _modified:
 #         indent=4
 #     )
 # )
-opcodes_map['totals'] = opcodes_totals
-_dumper(opcodes_map, output_folder, opcodes_file)
-
-conflicts = {}
-# Failed txs on contracts with unsupported opcodes,
-# as they could have failed because the unsupported opcode
-for _opcode in UNSUPPORTED_OPCODES:
-    conflicts[_opcode] = {}
-    for _addr in opcodes_map[_opcode]:
-        if opcodes_map[_opcode][_addr][0] > 0:
-            _failed_txs = contracts[_addr].get('failed_txs', [])
-            if _failed_txs:
-                conflicts[_opcode][_addr] = _failed_txs
-
-# Successful txs on contracts with changed opcodes,
-# as they could behave differently now
-for _opcode in CHANGED_OPCODES:
-    conflicts[_opcode] = {}
-    for _addr in opcodes_map[_opcode]:
-        if opcodes_map[_opcode][_addr][0] > 0:
-            _successful_txs = contracts[_addr].get('txs', [])
-            if _successful_txs:
-                conflicts[_opcode][_addr] = _successful_txs
-
-del contracts
-del opcodes_map
+
+_seq = _last_seq
+_new_conflicts = []
+for _seq, _addr, _tx, _success, _code_hash in store.iter_txs(_last_seq):
+    for _opcode, _wanted in get_runtime_flags(_code_hash):
+        if _success == _wanted:
+            _new_conflicts.append((_opcode, _addr, _tx, _seq))
+store.add_conflicts(_new_conflicts, _seq, _signature)
+print(
+    f"Checked txs after #{_last_seq} up to #{_seq}, "
+    f"new conflicts: {len(_new_conflicts)}")
+del _new_conflicts
+runtime_flags.clear()
+runtimes.clear()
+
+# Conflicting txs that 3_evaluator has not traced yet, the ones of earlier
+#  runs included. The store flags the ones found traced, so only the rest
+#  are looked up in the trace cache
+_untraced = store.untraced_conflicts()
+_trace_cache_filename = os.path.join(output_folder, trace_cache_db)
+if os.path.exists(_trace_cache_filename):
+    trace_cache = TraceCache(_trace_cache_filename)
+    _missing = set(trace_cache.missing(list(set(
+        _tx for _, _tx in _untraced))))
+    trace_cache.close()
+    store.set_traced(
+        _tx_seq for _tx_seq, _tx in _untraced if _tx not in _missing)
+    del _missing
+else:
+    store.reset_traced()
+del _untraced
+
+conflicts = {
+    _opcode: store.conflicts(_opcode) for _opcode in flagged_opcodes
+}
+conflicts_delta = {
+    _opcode: store.conflicts(_opcode, untraced=True)
+    for _opcode in flagged_opcodes
+}
+store.close()
 
 # Print conflicts summary
 for _opcode in conflicts:
@@ -124,10 +312,16 @@ for _opcode in conflicts:
     # total number of txs and addresses
     print(f"\tTotal txs: {sum(len(v) for v in conflicts[_opcode].values())}")
     print(f"\tTotal contracts: {len(conflicts[_opcode])}")
+    print(f"\tUnreachable in contracts (left out): {pruned[_opcode]}")
     print()
 
 _dumper(conflicts, output_folder, conflicts_file)
 del conflicts
+_dumper(conflicts_delta, output_folder, conflicts_delta_file)
+print(
+    "New txs to trace: ",
+    sum(len(v) for d in conflicts_delta.values() for v in d.values()))
+del conflicts_delta
 
 if False:
     # Convert string keys to numbers (integers or floats)
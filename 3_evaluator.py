@@ -4,7 +4,9 @@ import config as cfg
 from time import time
 from utils import chunks
 from downloader_helper import (
-    objects_retriever, trace_fetcher, _dumper)
+    objects_retriever, trace_fetcher, trace_opcodes, _dumper,
+    log_transport_stats)
+from storage import TraceCache
 
 output_folder = cfg.OUTPUT_FOLDER
 conflicts_file = cfg.CONFLICTS_FILE
@@ -12,6 +14,7 @@ conflicts = objects_retriever(os.path.join(output_folder, conflicts_file))
 reverted_file = cfg.REVERTED_FILE
 changed_file = cfg.CHANGED_FILE
 trace_cache_file = cfg.TRACE_CACHE_FILE
+trace_cache_db = cfg.TRACE_CACHE_DB
 
 global_start_time = time()
 
@@ -19,14 +22,6 @@ DEBUGS_PER_CHUNK = 500
 
 
 def find_issues_for_opcodes(opcodes_names, opcodes):
-    try:
-        trace_cache = \
-            objects_retriever(os.path.join(output_folder, trace_cache_file))
-    except FileNotFoundError:
-        trace_cache = {}
-    finally:
-        something_to_save = False
-
     issues_found = {
         _opcode: {} for _opcode in opcodes_names
     }
@@ -34,7 +29,7 @@ def find_issues_for_opcodes(opcodes_names, opcodes):
         for _addr, _txs in conflicts.get(_opcode, {}).items():
             _n_txs = len(_txs)
             is_ok = True
-            _txs_to_trace = [x for x in _txs if x not in trace_cache]
+            _txs_to_trace = trace_cache.missing(_txs)
             print(
                 f"Contract {_addr} | opcode {_opcode} | txs: {_n_txs} "
                 f"(to trace: {len(_txs_to_trace)})...", end=' '
@@ -48,16 +43,19 @@ def find_issues_for_opcodes(opcodes_names, opcodes):
                     print(f"{_i} ...", end=' ', flush=True)
                 _traces = trace_fetcher(_chunk_traces)
                 if _traces:
-                    for _trace in _traces:
-                        _steps = _trace.get('structLogs', [])
-                        _opcodes = list(set([x.get('op') for x in _steps]))
-                        _tx_hash = _trace.get('tx_hash')
-                        trace_cache[_tx_hash] = _opcodes
-                    something_to_save = True
+                    trace_cache.put_many(
+                        (_trace.get('tx_hash'), trace_opcodes(_trace))
+                        for _trace in _traces
+                    )
+                    # Appended on each chunk, in case we get killed
+                    trace_cache.commit()
                     del _traces
 
             for _tx in _txs:
                 _opcodes = trace_cache.get(_tx)
+                if _opcodes is None:
+                    print(f"\tCould not trace tx {_tx} for contract {_addr}")
+                    continue
                 _opcodes_found = \
                     [x for x in _opcodes if x in opcodes_names]
                 del _opcodes
@@ -78,18 +76,17 @@ def find_issues_for_opcodes(opcodes_names, opcodes):
             if is_ok:
                 print("OK")
 
-        # Saving after each opcode, just in case we get killed in between
-        if something_to_save:
-            _dumper(trace_cache, output_folder, trace_cache_file)
-            something_to_save = False
-
-    del trace_cache
     return issues_found
 
 
 # ADD TX COUNT FOR EACH CONTRACT
 # ADD DATES OF TXS?
 
+trace_cache = TraceCache(
+    os.path.join(output_folder, trace_cache_db),
+    legacy_filename=os.path.join(output_folder, trace_cache_file)
+)
+
 reverted_that_would_work_with_op = \
     find_issues_for_opcodes(
         cfg.UNSUPPORTED_OPCODES_NAMES, cfg.UNSUPPORTED_OPCODES)
@@ -98,6 +95,8 @@ _dumper(reverted_that_would_work_with_op, output_folder, reverted_file)
 success_that_would_behave_different = \
     find_issues_for_opcodes(cfg.CHANGED_OPCODES_NAMES, cfg.CHANGED_OPCODES)
 _dumper(success_that_would_behave_different, output_folder, changed_file)
+trace_cache.close()
 
+log_transport_stats()
 global_total_time = time() - global_start_time
 print(f"Total time: {global_total_time:.2f} seconds")
@@ -1,16 +1,16 @@
 #!/usr/bin/python3
 import sys
 import os
-import re
 import config as cfg
 from time import time
 from downloader_helper import objects_retriever
+from shards import list_shards, shard_batches, iter_shard
+from storage import ContractStore
 
 
 transactions_folder = cfg.TRANSACTIONS_FOLDER
 output_folder = cfg.OUTPUT_FOLDER
-contracts_file = cfg.CONTRACTS_FILE
-no_contracts_file = cfg.NO_CONTRACTS_CACHE
+contracts_db = cfg.CONTRACTS_DB
 conflicts_file = cfg.CONFLICTS_FILE
 reverted_file = cfg.REVERTED_FILE
 changed_file = cfg.CHANGED_FILE
@@ -21,35 +21,27 @@ summary = ""
 global_start_time = time()
 
 # get file list from folder
-existing_files = sorted(os.listdir(transactions_folder))
+existing_files = list_shards(transactions_folder)
 if not existing_files:
     print("No files to process.")
     sys.exit(1)
 
-last_file = existing_files[-1]
-last_batch = re.search(r"from_batch_\d+_to_(\d+)\.json", last_file).group(1)
-last_batch = int(last_batch)
+_, last_batch = shard_batches(existing_files[-1])
 
 total_txs = 0
 for _file in existing_files:
     full_path = os.path.join(transactions_folder, _file)
-    _txs = objects_retriever(full_path)
-    total_txs += len(_txs)
-    del _txs
+    total_txs += sum(1 for _ in iter_shard(full_path))
 
 summary += \
     f"Processed env {env} until batch {last_batch} " \
     f"with a total of {total_txs} txs."
 
 
-contracts = objects_retriever(os.path.join(output_folder, contracts_file))
-no_contracts = \
-    objects_retriever(os.path.join(output_folder, no_contracts_file))
-
-total_contracts = len(contracts)
-total_no_contracts = len(no_contracts)
-del contracts
-del no_contracts
+store = ContractStore(os.path.join(output_folder, contracts_db))
+total_contracts = store.count_contracts()
+total_no_contracts = store.count_no_contracts()
+store.close()
 
 summary += \
     f"\n- Addresses identified as contracts: {total_contracts}" \
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+import os
+import sys
+import config as cfg
+from time import time
+from utils import chunks
+from downloader_helper import batch_fetcher, log_transport_stats
+from shards import (
+    contained_shards, list_shards, shard_batches, shard_name, iter_shard,
+    write_shard)
+from storage import (
+    ContractStore, DownloadCheckpoint, EMPTY_BY_ERROR, MISSING_BATCH)
+
+# Batches of the transactions files checked against the coverage kept by
+#  0_downloader (the tx count of each batch, missing, or empty by error),
+#  without reading the files. repair fetches the missing batches (and the
+#  ones empty by error) again and rewrites their files:
+#  ENV=cardona ./batch_coverage.py [verify|repair]
+# Files downloaded before the coverage was kept are downloaded again on
+#  repair, as there is no way to tell their batches apart
+
+transactions_folder = cfg.TRANSACTIONS_FOLDER
+# Tx counts of the batches a file has no txs of, fetched again on repair
+NOT_FETCHED = (MISSING_BATCH, EMPTY_BY_ERROR)
+batches_per_iter = cfg.DOWNLOAD_BATCHES_PER_ITER
+
+mode = sys.argv[1] if len(sys.argv) > 1 else 'verify'
+if mode not in ('verify', 'repair'):
+    print("Usage: batch_coverage.py [verify|repair]")
+    sys.exit(1)
+
+
+def batch_ranges(batch_numbers):
+    # Sorted batch numbers as "a-b" runs, to print them short
+    runs = []
+    for batch_number in batch_numbers:
+        if runs and runs[-1][1] == batch_number - 1:
+            runs[-1][1] = batch_number
+        else:
+            runs.append([batch_number, batch_number])
+    return ', '.join(
+        str(first) if first == last else f"{first}-{last}"
+        for first, last in runs
+    )
+
+
+def repair(first_batch, last_batch, name):
+    # Txs of the batches the file has go to the checkpoint (split by their
+    #  tx counts), the missing ones (and the ones empty by error) are
+    #  fetched, and the file is written again from there if anything changed
+    done = checkpoint.done(first_batch, last_batch)
+    covered = coverage.get(first_batch)
+    if not (name and covered and covered[0] == last_batch):
+        covered = None
+    if covered:
+        tx_counts = covered[1]
+        txs = list(iter_shard(os.path.join(transactions_folder, name)))
+        if len(txs) == sum(c for c in tx_counts if c not in NOT_FETCHED):
+            batches = []
+            pos = 0
+            for _i, _count in enumerate(tx_counts):
+                if _count in NOT_FETCHED:
+                    continue
+                if first_batch + _i not in done:
+                    batches.append((first_batch + _i, txs[pos:pos + _count]))
+                pos += _count
+            checkpoint.add(batches)
+        else:
+            print(f"{name}: tx counts do not match, downloading it again")
+            covered = None
+        del txs
+
+    done = checkpoint.done(first_batch, last_batch)
+    missing = [
+        _id for _id in range(first_batch, last_batch + 1) if _id not in done
+    ]
+    cfg.linfo(
+        f"Downloading {len(missing)} batches from {first_batch} "
+        f"to {last_batch}.")
+    batch_fetcher(missing, errors=errors, on_batches=checkpoint.add)
+    tx_counts = checkpoint.tx_counts(first_batch, last_batch)
+    n_empty_by_error[0] += tx_counts.count(EMPTY_BY_ERROR)
+    if covered and tx_counts == covered[1]:
+        # Answered the same, the file is kept as it is (rewriting it would
+        #  have step 1 process it again)
+        print(f"{name}: no new batches")
+        if last_batch - first_batch + 1 >= batches_per_iter:
+            checkpoint.clear(first_batch, last_batch)
+        return
+    txs = list(checkpoint.iter_txs(first_batch, last_batch))
+    write_shard(
+        txs, transactions_folder,
+        name or shard_name(first_batch, last_batch))
+    checkpoint.shard_written(
+        first_batch, last_batch,
+        last_batch - first_batch + 1 >= batches_per_iter)
+
+
+global_start_time = time()
+checkpoint = DownloadCheckpoint(
+    os.path.join(cfg.OUTPUT_FOLDER, cfg.DOWNLOAD_CHECKPOINT_DB))
+coverage = {
+    first_batch: (last_batch, tx_counts)
+    for first_batch, last_batch, tx_counts in checkpoint.coverage()
+}
+
+# (first batch, last batch, file name or None) to repair, and files to
+#  remove: the ones with all their batches in another file (left by a
+#  killed 0_downloader), and the ones overlapping the previous file, whose
+#  batches after it are downloaded again
+damaged = []
+overlaps = []
+files = list_shards(transactions_folder)
+# Of files with the same batches, the one step 1 processed is kept
+_processed = ()
+_contracts_db = os.path.join(cfg.OUTPUT_FOLDER, cfg.CONTRACTS_DB)
+if os.path.exists(_contracts_db):
+    _store = ContractStore(_contracts_db)
+    _processed = set(_file for _file, *_ in _store.processed_files())
+    _store.close()
+contained = set(contained_shards(files, _processed))
+next_batch = 0
+n_batches = 0
+n_missing = 0
+# Batches empty by error, found on verify or still so after repair
+n_empty_by_error = [0]
+n_txs = 0
+for _file in files:
+    _first, _last = shard_batches(_file)
+    if _file in contained:
+        print(f"{_file}: batches already in another file")
+        overlaps.append(_file)
+        continue
+    if _first < next_batch:
+        print(f"{_file}: overlaps the previous file")
+        overlaps.append(_file)
+        continue
+    for _gap in chunks(list(range(next_batch, _first)), batches_per_iter):
+        print(f"No file for batches {_gap[0]} to {_gap[-1]}")
+        damaged.append((_gap[0], _gap[-1], None))
+        n_missing += len(_gap)
+    next_batch = max(next_batch, _last + 1)
+
+    _covered = coverage.get(_first)
+    if not _covered or _covered[0] != _last:
+        print(f"{_file}: no coverage")
+        damaged.append((_first, _last, _file))
+        n_missing += _last - _first + 1
+        continue
+    _tx_counts = _covered[1]
+    _missing = [
+        _first + _i for _i, _count in enumerate(_tx_counts)
+        if _count == MISSING_BATCH
+    ]
+    _empty_by_error = [
+        _first + _i for _i, _count in enumerate(_tx_counts)
+        if _count == EMPTY_BY_ERROR
+    ]
+    n_batches += len(_tx_counts) - len(_missing)
+    n_txs += sum(_count for _count in _tx_counts if _count not in NOT_FETCHED)
+    if _missing:
+        print(
+            f"{_file}: {len(_missing)} batches missing: "
+            f"{batch_ranges(_missing)}")
+        n_missing += len(_missing)
+    if _empty_by_error:
+        print(
+            f"{_file}: {len(_empty_by_error)} batches answered with an "
+            f"error, taken as empty: {batch_ranges(_empty_by_error)}")
+        n_empty_by_error[0] += len(_empty_by_error)
+    if _missing or _empty_by_error:
+        damaged.append((_first, _last, _file))
+
+print(
+    f"Files: {len(files)} | Batches: {n_batches} of {next_batch}, "
+    f"{n_missing} missing, {n_empty_by_error[0]} empty by error | "
+    f"Txs: {n_txs} | Overlapping files: {len(overlaps)}"
+)
+
+errors = []
+if mode == 'repair':
+    n_empty_by_error[0] = 0
+    for _file in overlaps:
+        print(f"Removing {_file}")
+        os.remove(os.path.join(transactions_folder, _file))
+    for _first, _last, _file in damaged:
+        start_time = time()
+        repair(_first, _last, _file)
+        print(
+            f"Repaired batches {_first} to {_last} "
+            f"in {time() - start_time:.2f} seconds"
+        )
+    if damaged:
+        log_transport_stats()
+    if errors:
+        print(f"{len(errors)} batches still missing")
+    if n_empty_by_error[0]:
+        print(
+            f"{n_empty_by_error[0]} batches still answered with an error, "
+            f"taken as empty")
+
+checkpoint.close()
+global_total_time = time() - global_start_time
+print(f"Total time: {global_total_time:.2f} seconds")
+
+if errors or ((damaged or overlaps) and mode == 'verify'):
+    sys.exit(1)
@@ -23,17 +23,73 @@ elif env == 'bali':
     OUTPUT_FOLDER = "zkevm_bali"
     TRANSACTIONS_FOLDER = "zkevm_bali/transactions"
 
-CONTRACTS_FILE = "contracts.json"
+# Several endpoints can be given per role, comma separated, with an optional
+#  weight after '|': EP_LIST="http://node1:8545|2,http://node2:8545".
+#  Requests are spread among them, by default EP / EP_DEBUG only
+EP_LIST = os.environ.get('EP_LIST', EP)
+EP_DEBUG_LIST = os.environ.get('EP_DEBUG_LIST', EP_DEBUG)
+
+CONTRACTS_DB = "contracts.sqlite"
+CONTRACTS_FILE = "contracts.json"  # Export of CONTRACTS_DB
+RUNTIMES_FILE = "runtimes.json"  # Export of CONTRACTS_DB, by code hash
 OPCODES_FILE = "opcodes.json"
+OPCODE_INDEX_FILE = "opcode_index.bin"  # Queried with opcode_query.py
 CONFLICTS_FILE = "conflicts.json"
+CONFLICTS_DELTA_FILE = "conflicts_delta.json"  # Txs not traced yet
+PROFILE_CONFLICTS_FILE = "conflicts_{profile}.json"  # From opcode_profile.py
 REVERTED_FILE = "reverted.json"
 CHANGED_FILE = "changed.json"
 NO_CONTRACTS_CACHE = "no_contracts.json"
-TRACE_CACHE_FILE = "trace_cache.json"
+TRACE_CACHE_FILE = "trace_cache.json"  # Legacy, imported to TRACE_CACHE_DB
+TRACE_CACHE_DB = "trace_cache.sqlite"
+DOWNLOAD_CHECKPOINT_DB = "download_checkpoint.sqlite"  # Shard in progress
+
+# Export contracts store to CONTRACTS_FILE / RUNTIMES_FILE /
+#  NO_CONTRACTS_CACHE json files
+EXPORT_JSON = os.environ.get('EXPORT_JSON', '1') == '1'
+
+# Transactions files: one tx per line (NDJSON), compressed with gzip ('gz')
+#  or lzma ('xz'), 'json' for the former pretty-printed json array
+TX_SHARD_FORMAT = os.environ.get('TX_SHARD_FORMAT', 'gz')
+# Tx fields kept as batches are downloaded: 'slim' keeps only what next
+#  steps read (input only for contract creations), 'full' keeps them all
+TX_FIELDS = os.environ.get('TX_FIELDS', 'slim')
+TX_SLIM_FIELDS = ('hash', 'from', 'to', 'blockNumber')
+TX_SLIM_RECEIPT_FIELDS = ('contractAddress', 'status')
 
 DOWNLOAD_BATCHES_PER_ITER = 10000
+# Chunks of DOWNLOAD_BATCHES_PER_ITER fetched while the previous ones are
+#  written, fetching waits for the writer beyond them
+DOWNLOAD_CHUNKS_AHEAD = int(os.environ.get('DOWNLOAD_CHUNKS_AHEAD', 1))
 DOWNLOAD_QUERIES_PER_REQUEST = 20
-TRACES_QUERIES_PER_REQUEST = 5  # Traces can be very large
+# Traces can be very large, but they are reduced to their opcodes while
+#  the response is read, so memory does not grow with the batch size
+TRACES_QUERIES_PER_REQUEST = 20
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# TRACING: 'opcodes' asks the node only for the distinct executed opcodes
+#  through a JS tracer, falling back to 'structlogs' if not supported
+TRACE_MODE = os.environ.get('TRACE_MODE', 'opcodes')
+OPCODES_TRACER = \
+    "{ops: {}, " \
+    "step: function(log) { this.ops[log.op.toString()] = true; }, " \
+    "fault: function(log) {}, " \
+    "result: function() { return Object.keys(this.ops); }}"
+
+# RPC CACHE: answers that cannot change (batches up to the verified one,
+#  contract codes, traces) kept on OUTPUT_FOLDER and replayed on reruns.
+#  'off', 'record' (replays the ones kept, fetches and keeps the rest) or
+#  'replay' (only replays, nothing is sent for them)
+RPC_CACHE = os.environ.get('RPC_CACHE', 'off')
+RPC_CACHE_DB = "rpc_cache.sqlite"
+RPC_CACHE_MAX_MB = int(os.environ.get('RPC_CACHE_MAX_MB', 4096))
+RPC_CACHE_METHODS = \
+    ('zkevm_getBatchByNumber', 'eth_getCode', 'debug_traceTransaction')
+
+# HTTP TRANSPORT
+HTTP_POOL_SIZE = 32  # Connections kept alive per endpoint
+HTTP_SESSION_PER_THREAD = os.environ.get('HTTP_SESSION_PER_THREAD') == '1'
+HTTP_GZIP = os.environ.get('HTTP_GZIP', '1') == '1'
 
 # OPCODES
 UNSUPPORTED_OPCODES = ("49", "4a", "5c", "5d", "5e")
@@ -44,8 +100,52 @@ CHANGED_OPCODES = ("ff", "3f", "40", "44")
 CHANGED_OPCODES_NAMES = \
     ('SELFDESTRUCT', 'EXTCODEHASH', 'BLOCKHASH', 'DIFFICULTY')
 
+# Opcode sets checked by opcode_profile.py from the runtime masks, without
+#  scanning the runtimes again. Unsupported opcodes are matched with the
+#  failed txs of each contract, changed ones with the successful txs
+OPCODE_PROFILES = {
+    'zkevm': {
+        'unsupported': UNSUPPORTED_OPCODES,
+        'changed': CHANGED_OPCODES,
+    },
+    'shanghai': {  # PUSH0
+        'unsupported': ("5f",),
+        'changed': (),
+    },
+    'cancun': {  # BLOBHASH, BLOBBASEFEE, TLOAD, TSTORE, MCOPY | SELFDESTRUCT
+        'unsupported': ("49", "4a", "5c", "5d", "5e"),
+        'changed': ("ff",),
+    },
+    'osaka': {  # CLZ
+        'unsupported': ("1e",),
+        'changed': (),
+    },
+}
+
 # CPU / MULTITHREAD PROCESSING
 THREAD_COUNT = multiprocessing.cpu_count()
+# Processes scanning runtimes on 2_analyzer, 1 to scan them serially
+ANALYZER_PROCESSES = int(os.environ.get('ANALYZER_PROCESSES', THREAD_COUNT))
+ANALYZER_RUNTIMES_PER_TASK = 200
+# Leave out of conflicts the contracts where the opcode is unreachable
+REACHABILITY_FILTER = os.environ.get('REACHABILITY_FILTER', '1') == '1'
+# Check only the txs added since the last run for conflicts
+ANALYZER_INCREMENTAL = os.environ.get('ANALYZER_INCREMENTAL', '1') == '1'
+# RPC requests in flight at the same time per endpoint, not tied to cpu
+#  count (I/O bound)
+RPC_MAX_IN_FLIGHT = int(os.environ.get('RPC_MAX_IN_FLIGHT', 16))
+
+# ADAPTIVE RPC CONTROL (AIMD on in-flight requests and batch sizes)
+RPC_ADAPTIVE = os.environ.get('RPC_ADAPTIVE', '1') == '1'
+RPC_INITIAL_IN_FLIGHT = 4
+RPC_MAX_BATCH_FACTOR = 4  # Batch sizes can grow up to 4x the configured ones
+RPC_TARGET_LATENCY = 5  # Seconds, slower answers shrink the batch size
+RPC_MAX_RESPONSE_BYTES = 64 * 1024 * 1024
+RPC_THROTTLE_COOLDOWN = 1  # Seconds, doubled on each consecutive 429
+RPC_THROTTLE_COOLDOWN_MAX = 30
+# Endpoints failing this many requests in a row are left aside for a while
+RPC_EP_MAX_FAILURES = 3
+RPC_EP_DOWN_COOLDOWN = 30  # Seconds
 
 # FUNCS & INITIALIZATION
 LOGLEVEL = os.environ.get('LOGLEVEL', logging.INFO)
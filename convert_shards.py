@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+import os
+import sys
+import config as cfg
+from time import time
+from shards import (
+    EXTENSIONS, contained_shards, list_shards, shard_batches, shard_name,
+    iter_shard, write_shard)
+from storage import ContractStore
+
+# One-off conversion of the transactions files to another format
+#  (TX_SHARD_FORMAT by default), like the former json arrays to NDJSON:
+#  ENV=cardona ./convert_shards.py [gz|xz|ndjson|json]
+# Files already folded in by 1_processor are renamed on its store too
+
+transactions_folder = cfg.TRANSACTIONS_FOLDER
+contracts_db = os.path.join(cfg.OUTPUT_FOLDER, cfg.CONTRACTS_DB)
+
+shard_format = sys.argv[1] if len(sys.argv) > 1 else cfg.TX_SHARD_FORMAT
+if shard_format not in EXTENSIONS:
+    print(f"Unknown format {shard_format}, available: {', '.join(EXTENSIONS)}")
+    sys.exit(1)
+
+global_start_time = time()
+store = ContractStore(contracts_db) if os.path.exists(contracts_db) else None
+size_before = 0
+size_after = 0
+
+# A conversion killed before removing the former file left both, the one
+#  in the manifest (or in the newest format) is kept
+_processed = set(
+    _file for _file, *_ in store.processed_files()) if store else ()
+for _file in contained_shards(list_shards(transactions_folder), _processed):
+    print(f"Removing {_file}, its batches are in another file")
+    os.remove(os.path.join(transactions_folder, _file))
+
+for _file in list_shards(transactions_folder):
+    _new_file = shard_name(*shard_batches(_file), shard_format)
+    if _new_file == _file:
+        continue
+    start_time = time()
+    full_path = os.path.join(transactions_folder, _file)
+    new_path = os.path.join(transactions_folder, _new_file)
+
+    _txs = list(iter_shard(full_path))
+    _hash = write_shard(_txs, transactions_folder, _new_file)
+    # Read back before the former file goes away
+    _n_txs = 0
+    for _tx, _new_tx in zip(_txs, iter_shard(new_path)):
+        assert _tx == _new_tx, f"Tx {_tx.get('hash')} differs on {new_path}"
+        _n_txs += 1
+    assert _n_txs == len(_txs), f"{new_path} has {_n_txs} txs"
+    del _txs
+
+    _stat = os.stat(new_path)
+    if store and store.is_processed(_file):
+        store.rename_file(
+            _file, _new_file, _stat.st_size, _stat.st_mtime, _hash)
+    size_before += os.path.getsize(full_path)
+    size_after += _stat.st_size
+    os.remove(full_path)
+    print(
+        f"Converted {full_path} to {_new_file}, {_n_txs} txs "
+        f"in {time() - start_time:.2f} seconds"
+    )
+
+if store:
+    store.close()
+if size_before:
+    print(
+        f"Size: {size_before / 2**20:.1f}MB -> {size_after / 2**20:.1f}MB")
+global_total_time = time() - global_start_time
+print(f"Total time: {global_total_time:.2f} seconds")
@@ -1,12 +1,30 @@
+import asyncio
 import requests
 import json
-import math
 import time
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock, local, enumerate as threads, get_ident
+from requests.adapters import HTTPAdapter
 from pathlib import Path
-from utils import chunks
+from json_stream import reduce_traces
+from rpc_controller import get_controller, get_pool, controllers
+from storage import RPCCache
 import config as cfg
 
+# Sessions by thread id (None for the shared one), and the counts of the
+#  ones closed as their thread ended
+_sessions = {}
+_closed_sessions = {'sessions': 0, 'requests': 0, 'handshakes': 0}
+_sessions_lock = Lock()
+_thread_sessions = local()
+_opcodes_tracer = {'supported': None}
+_rpc_cache = {'cache': None}
+_rpc_cache_lock = Lock()
+# Thread pools of AsyncRPCClient by endpoints list, kept for the whole run
+_executors = {}
+_executors_lock = Lock()
+
 
 def get_last_batch_number(ep):
     last_batch_hex = geth_request(ep=ep, method='zkevm_batchNumber')
@@ -15,7 +33,7 @@ def get_last_batch_number(ep):
 
 def get_last_verified_batch_number():
     last_batch_hex = geth_request(
-        ep=cfg.EP, method='zkevm_verifiedBatchNumber')
+        ep=cfg.EP_LIST, method='zkevm_verifiedBatchNumber')
     return int(last_batch_hex, base=16)
 
 
@@ -30,82 +48,209 @@ def trace_transaction(tx_hash):
         }
     ]
     return geth_request(
-        ep=cfg.EP_DEBUG, method='debug_traceTransaction', params=params
+        ep=cfg.EP_DEBUG_LIST, method='debug_traceTransaction', params=params
     )
 
 
-def trace_fetcher(tx_hashes):
-    class Fetcher(Thread):
-        def __init__(self, ep, tx_hashes):
-            Thread.__init__(self)
-            self.ep = ep
-            self.tx_hashes = tx_hashes
-            self.traces = []
-            self.params = {
-                "disableStorage": True,
-                "disableStack": True,
-                "disableMemory": True,
-                "disableReturnData": True,
+def _trace_fetcher(tx_hashes, params, errors):
+    traces = []
+    for _, _traces in rpc_fetcher(
+        ep=cfg.EP_DEBUG_LIST,
+        requests=[
+            {
+                'method': 'debug_traceTransaction',
+                'params': [tx_hash, params],
+                'id': tx_hash
             }
+            for tx_hash in tx_hashes
+        ],
+        queries_per_request=cfg.TRACES_QUERIES_PER_REQUEST,
+        map_from_id='tx_hash', errors=errors, stream_parser=reduce_traces
+    ):
+        traces.extend(_traces)
+    return traces
 
-        def run(self):
-            for chunk_tx_hashes in chunks(
-                self.tx_hashes, cfg.TRACES_QUERIES_PER_REQUEST
-            ):
-                _traces = geth_request_multi(
-                    ep=self.ep,
-                    requests=[
-                        {
-                            'method': 'debug_traceTransaction',
-                            'params': [tx_hash, self.params],
-                            'id': tx_hash
-                        }
-                        for tx_hash in chunk_tx_hashes
-                    ],
-                    map_from_id='tx_hash'
-                )
-                if _traces and isinstance(_traces, list):
-                    if len(_traces) != len(chunk_tx_hashes):
-                        cfg.lerror(
-                            f"Fetcher.run ep={self.ep}, "
-                            f"sent {len(chunk_tx_hashes)}, "
-                            f"got {len(_traces)} traces"
-                        )
-                    self.traces.extend(_traces)
-                else:
-                    cfg.lerror(
-                        f"Fetcher.run ep={self.ep} "
-                        f"tx_hashes={chunk_tx_hashes} traces={_traces}"
-                    )
-
-    ep = cfg.EP_DEBUG
-    threads = []
-    chunk_size = int(
-        math.ceil(len(tx_hashes)/cfg.THREAD_COUNT)
+
+def opcodes_tracer_supported(tx_hash):
+    # Probe with a single tx, without retries, if the node runs our tracer.
+    #  Only an answer rejecting the tracer settles it as not supported, on
+    #  transient failures (timeouts, throttling, no answer) structLogs are
+    #  used this time and the next call probes again
+    if _opcodes_tracer['supported'] is None:
+        _errors = []
+        probe = geth_request_multi(
+            ep=cfg.EP_DEBUG_LIST,
+            requests=[{
+                'method': 'debug_traceTransaction',
+                'params': [tx_hash, {'tracer': cfg.OPCODES_TRACER}],
+                'id': tx_hash
+            }],
+            retries=0, map_from_id='tx_hash', errors=_errors
+        )
+        if probe and isinstance(probe[0].get('result'), list):
+            _opcodes_tracer['supported'] = True
+        elif probe or any(
+            _tracer_rejected(_error['error']) for _error in _errors
+        ):
+            _opcodes_tracer['supported'] = False
+            cfg.linfo("Opcodes tracer not supported, using structLogs.")
+        else:
+            cfg.linfo(
+                f"Opcodes tracer probe failed: "
+                f"{[_error['error'] for _error in _errors]}, using "
+                f"structLogs for now.")
+            return False
+    return _opcodes_tracer['supported']
+
+
+def _tracer_rejected(error):
+    # Errors of a node without JS tracers, or failing to run ours
+    message = str(error.get('message', '')).lower()
+    return error.get('code') == -32601 or any(
+        _text in message for _text in (
+            'tracer', 'not supported', 'referenceerror', 'syntaxerror',
+            'typeerror')
     )
 
-    for chunk_tx_hashes in chunks(tx_hashes, chunk_size):
-        t = Fetcher(ep, chunk_tx_hashes)
-        t.start()
-        threads.append(t)
 
+def trace_fetcher(tx_hashes, errors=None):
+    params = {
+        "disableStorage": True,
+        "disableStack": True,
+        "disableMemory": True,
+        "disableReturnData": True,
+    }
     traces = []
-    for t in threads:
-        t.join()
-        traces.extend(t.traces)
+    _errors = []
+
+    if cfg.TRACE_MODE == 'opcodes' and tx_hashes and \
+            opcodes_tracer_supported(tx_hashes[0]):
+        for _trace in _trace_fetcher(
+            tx_hashes, {'tracer': cfg.OPCODES_TRACER}, _errors
+        ):
+            traces.append({
+                'tx_hash': _trace.get('tx_hash'),
+                'opcodes': _trace.get('result'),
+            })
+        # Whatever failed with the tracer is retried with structLogs
+        tx_hashes = [e['id'] for e in _errors]
+        _errors = []
+
+    traces.extend(_trace_fetcher(tx_hashes, params, _errors))
+
+    if _errors:
+        cfg.lerror(
+            f"trace_fetcher ep={cfg.EP_DEBUG_LIST}, "
+            f"got {len(traces)} traces, failed: {[e['id'] for e in _errors]}"
+        )
+        if errors is not None:
+            errors.extend(_errors)
 
     return traces
 
 
+def trace_opcodes(trace):
+    # Distinct opcodes executed, either from our tracer or from structLogs
+    if 'opcodes' in trace:
+        return trace['opcodes']
+    return list(set([x.get('op') for x in trace.get('structLogs') or []]))
+
+
 def get_last_block_number(ep):
     last_block_hex = geth_request(ep=ep, method='eth_blockNumber')
     return int(last_block_hex, base=16)
 
 
+def _new_session(ident=None):
+    session = requests.Session()
+    # pool_block keeps the pool bounded, extra threads wait for a connection
+    adapter = HTTPAdapter(
+        pool_connections=cfg.HTTP_POOL_SIZE, pool_maxsize=cfg.HTTP_POOL_SIZE,
+        pool_block=True
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = \
+        'gzip, deflate' if cfg.HTTP_GZIP else 'identity'
+    _sessions[ident] = session
+    return session
+
+
+def _session_counts(session):
+    requests_count = 0
+    handshakes = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_count += pool.num_requests
+                handshakes += pool.num_connections
+    return requests_count, handshakes
+
+
+def _close_session(ident):
+    session = _sessions.pop(ident)
+    requests_count, handshakes = _session_counts(session)
+    _closed_sessions['sessions'] += 1
+    _closed_sessions['requests'] += requests_count
+    _closed_sessions['handshakes'] += handshakes
+    session.close()
+
+
+def get_session():
+    if cfg.HTTP_SESSION_PER_THREAD:
+        if not hasattr(_thread_sessions, 'session'):
+            with _sessions_lock:
+                # Sessions of ended threads are closed here, or they would
+                #  pile up with their connections (a thread id can be taken
+                #  again by a new thread, so its old session goes too)
+                alive = set(_thread.ident for _thread in threads())
+                for _ident in list(_sessions):
+                    if _ident is not None and (
+                            _ident not in alive or _ident == get_ident()):
+                        _close_session(_ident)
+                _thread_sessions.session = _new_session(get_ident())
+        return _thread_sessions.session
+
+    with _sessions_lock:
+        if None not in _sessions:
+            _new_session()
+        return _sessions[None]
+
+
+def transport_stats():
+    with _sessions_lock:
+        stats = dict(_closed_sessions)
+        stats['open'] = len(_sessions)
+        stats['sessions'] += len(_sessions)
+        for session in _sessions.values():
+            requests_count, handshakes = _session_counts(session)
+            stats['requests'] += requests_count
+            stats['handshakes'] += handshakes
+    stats['reused'] = stats['requests'] - stats['handshakes']
+    return stats
+
+
+def log_transport_stats():
+    stats = transport_stats()
+    cfg.linfo(
+        f"HTTP transport: sessions={stats['sessions']} "
+        f"(open={stats['open']}) "
+        f"requests={stats['requests']} handshakes={stats['handshakes']} "
+        f"reused={stats['reused']}"
+    )
+    for controller in controllers():
+        cfg.linfo(f"RPC controller: {controller}")
+    if _rpc_cache['cache']:
+        cfg.linfo(f"RPC cache: {_rpc_cache['cache']}")
+
+
 def endpoint_request(
     method='GET', endpoint=None, path='/', url=None, params=None, body=None,
     data=None, headers=None, auth=None, max_attempts=10, trhottle_cooldown=10,
-    error_handler={}, debug=False
+    error_handler={}, debug=False, controller=None, rpc_method=None,
+    rpc_items=1, stream_parser=None, pool=None, failed_items=None
 ):
     if not path.startswith('/'):
         path = f'/{path}'
@@ -127,18 +272,58 @@ def endpoint_request(
         kwargs['headers'] = headers
     if auth:
         kwargs['auth'] = auth
+    if stream_parser:
+        kwargs['stream'] = True
 
     if debug:
         cfg.ldebug(f'kwargs:{kwargs}')
 
+    # With a pool of endpoints each attempt picks one, a failed one is
+    #  replaced right away by another one up (if any) instead of waiting
+    failover = pool is not None and len(pool) > 1
+    failed_url = None
     for attempt in range(1, max_attempts+1):
+        if pool is not None:
+            kwargs['url'] = pool.pick(exclude=failed_url)
+            controller = get_controller(kwargs['url'])
+        start_time = time.time()
         try:
-            req = requests.request(**kwargs)
             try:
-                content = req.json()
+                req = get_session().request(**kwargs)
+            except requests.exceptions.RequestException:
+                if controller:
+                    controller.record(
+                        rpc_method, rpc_items, None,
+                        time.time() - start_time, 0)
+                raise
+            rcode = req.status_code
+            received = 0
+            try:
+                if stream_parser and rcode == 200:
+                    # Body is parsed while read, never fully kept in memory
+                    def _chunks():
+                        nonlocal received
+                        for chunk in req.iter_content(
+                            chunk_size=cfg.STREAM_CHUNK_SIZE
+                        ):
+                            received += len(chunk)
+                            yield chunk
+                    content = stream_parser(_chunks())
+                else:
+                    content = req.json()
+                    received = len(req.content)
             except ValueError:
                 content = req.reason
-            rcode = req.status_code
+            finally:
+                req.close()
+            if controller:
+                # failed_items counts the items the node answered with an
+                #  error, they count toward the endpoint health
+                controller.record(
+                    rpc_method, rpc_items, rcode, time.time() - start_time,
+                    received,
+                    failed_items(content) if failed_items and rcode == 200
+                    else 0)
 
             if rcode in error_handler:
                 function = error_handler.get(rcode)
@@ -146,8 +331,14 @@ def endpoint_request(
                 raise requests.exceptions.HTTPError(
                     f'Handle attempt: {rcode}: {content} for url {req.url}')
 
+            if rcode == 429 and not (
+                failover and pool.up(exclude=kwargs['url'])
+            ):
+                if controller and controller.adaptive:
+                    time.sleep(controller.throttle_cooldown())
+                else:
+                    time.sleep(trhottle_cooldown)
             if rcode == 429:
-                time.sleep(trhottle_cooldown)
                 raise requests.exceptions.HTTPError(
                     f'Throttled!! {rcode}: {content} for url {req.url}')
             if rcode >= 500:
@@ -159,21 +350,85 @@ def endpoint_request(
         except requests.exceptions.RequestException as e:
             if attempt < max_attempts:
                 cfg.linfo(e)
-                time.sleep(attempt*attempt)
+                if failover:
+                    failed_url = kwargs['url']
+                if not (failover and pool.up(exclude=failed_url)):
+                    time.sleep(attempt*attempt)
             else:
                 cfg.lerror(e)
                 raise
 
 
+def get_rpc_cache():
+    if cfg.RPC_CACHE == 'off':
+        return None
+    with _rpc_cache_lock:
+        if _rpc_cache['cache'] is None:
+            _rpc_cache['cache'] = RPCCache(
+                f"{cfg.OUTPUT_FOLDER}/{cfg.RPC_CACHE_DB}",
+                cfg.RPC_CACHE_MAX_MB * 2**20)
+        return _rpc_cache['cache']
+
+
+def _cache_key(cache, request, stream_parser):
+    # Keyed by the request only, not by the endpoints, which can change
+    #  between runs (or be the same for both roles). Methods already tell
+    #  the roles apart
+    return cache.key(
+        request['method'], request.get('params'),
+        stream_parser.__name__ if stream_parser else None)
+
+
+def _crashed(answer):
+    return (answer.get('error') or {}).get('message', '') == \
+        'method handler crashed'
+
+
+def _failed_items(content):
+    # Items of a batch answered with an error, but 'method handler crashed'
+    #  which is how the node answers empty batches
+    if not isinstance(content, list):
+        return 0
+    return sum(
+        1 for c in content
+        if isinstance(c, dict) and c.get('result') is None and not _crashed(c)
+    )
+
+
+def _cached_answer(answer):
+    # What is kept of an answer, None if nothing. Only results are kept,
+    #  errors are always asked again, but 'method handler crashed' (empty
+    #  batches) is kept as a marker, so a replay gets what was recorded.
+    #  Empty codes are not kept, the address may get a contract later
+    r = answer.get('result')
+    if r is not None:
+        return {'result': r} if r != '0x' else None
+    if _crashed(answer):
+        return {'empty_batch': True}
+    return None
+
+
 def geth_request(ep, method, params=[], retries=3, debug=False):
+    cache = get_rpc_cache() if method in cfg.RPC_CACHE_METHODS else None
+    if cache:
+        key = _cache_key(cache, {'method': method, 'params': params}, None)
+        if r := cache.get_many([key]).get(key, {}).get('result'):
+            return r
+        if cfg.RPC_CACHE == 'replay':
+            cfg.lerror(
+                f"geth_request method={method} params={params} "
+                f"not in the RPC cache")
+            return None
     (rcode, content) = endpoint_request(
         method='POST', endpoint='Unused', url=ep,
         body={'method': method, 'params': params, 'id': 1},
         headers={'Content-Type': 'application/json'},
-        debug=debug
+        debug=debug, pool=get_pool(ep), rpc_method=method
     )
     if rcode == 200:
         if r := content.get('result'):
+            if cache and (_answer := _cached_answer(content)):
+                cache.put_many([(key, _answer)])
             return r
         elif content.get('error') and retries:
             return geth_request(ep, method, params, retries-1)
@@ -188,44 +443,206 @@ def geth_request(ep, method, params=[], retries=3, debug=False):
         return None
 
 
-def geth_request_multi(ep, requests, retries=5, map_from_id='number'):
-    (rcode, content) = endpoint_request(
-        method='POST', endpoint='Unused', url=ep, body=requests,
-        headers={'Content-Type': 'application/json'},
-    )
-    if rcode == 200:
-        result = []
-        for c in content:
-            if r := c.get('result'):
-                if isinstance(r, str):
-                    r = {'result': r}
-                # The id has been set to batch number when querying
-                if map_from_id:
-                    r[map_from_id] = c.get('id')
-                result.append(r)
-            elif c.get('error') and retries:
-                # this error is thrown when there are no txs in the batch
-                if c.get('error').get('message', '') == \
-                        'method handler crashed':
-                    continue
-                retry_in = (10-retries)*2
-                cfg.linfo(
-                    f"RETRY for geth_request ep={ep} "
-                    f"retries={retries} answer={c} sleep={retry_in} "
-                    f"body={requests}")
-                time.sleep(retry_in)
-                return geth_request_multi(
-                    ep, requests, retries-1, map_from_id=map_from_id)
-            else:
-                cfg.lerror(
-                    f"geth_request ep={ep} request={requests} "
-                    f"retries={retries} answer={c}")
-                return None
-        return result
+def _geth_request_multi(
+    ep, requests, retries, map_from_id, errors, stream_parser
+):
+    # Answers kept on the RPC cache are replayed, only the rest is sent
+    answers = {}
+    keys = {}
+    cache = get_rpc_cache()
+    if cache:
+        keys = {
+            request['id']: _cache_key(cache, request, stream_parser)
+            for request in requests
+            if request['method'] in cfg.RPC_CACHE_METHODS
+        }
+        found = cache.get_many(keys.values())
+        for _id, key in keys.items():
+            # Empty batch markers are only replayed offline, when recording
+            #  they are asked again, as the node may have failed on the batch
+            if key in found and not (
+                found[key].get('empty_batch') and cfg.RPC_CACHE != 'replay'
+            ):
+                answers[_id] = {**found[key], 'id': _id}
+        if cfg.RPC_CACHE == 'replay':
+            for request in requests:
+                answers.setdefault(
+                    request['id'],
+                    {'error': {'message': 'not in the RPC cache'}})
+            retries = 0
+
+    rcode = None
+    pending = [request for request in requests if request['id'] not in answers]
+    if pending:
+        (rcode, content) = endpoint_request(
+            method='POST', endpoint='Unused', url=ep, body=pending,
+            headers={'Content-Type': 'application/json'}, pool=get_pool(ep),
+            rpc_method=pending[0].get('method'), rpc_items=len(pending),
+            stream_parser=stream_parser, failed_items=_failed_items
+        )
+        if rcode == 200 and isinstance(content, list):
+            fetched = {c.get('id'): c for c in content}
+            answers.update(fetched)
+            if cache:
+                cache.put_many(
+                    (keys[_id], _answer)
+                    for _id in keys
+                    if _id in fetched and
+                    (_answer := _cached_answer(fetched[_id])) is not None
+                )
+        else:
+            cfg.lerror(
+                f"utils.geth_request rcode=={rcode} content={content}")
+
+    results = {}
+    failed = []
+    for request in requests:
+        c = answers.get(request['id'], {})
+        if (r := c.get('result')) is not None:
+            if not isinstance(r, dict):
+                r = {'result': r}
+            # The id has been set to batch number when querying
+            if map_from_id:
+                r[map_from_id] = c.get('id')
+            results[request['id']] = r
+        elif _crashed(c) or c.get('empty_batch'):
+            # this error is thrown when there are no txs in the batch (but
+            #  also when the node fails on one): neither in the results nor
+            #  failed, so callers can tell these apart
+            continue
+        else:
+            failed.append(
+                (request, c.get('error') or {'message': f'no answer {rcode}'})
+            )
+
+    # Only the failed items are sent again, successful ones are kept
+    if failed and retries:
+        retry_in = (10-retries)*2
+        cfg.linfo(
+            f"RETRY for geth_request ep={ep} retries={retries} "
+            f"failed={len(failed)}/{len(requests)} sleep={retry_in} "
+            f"answers={[error for _, error in failed]}")
+        time.sleep(retry_in)
+        results.update(_geth_request_multi(
+            ep, [request for request, _ in failed], retries-1, map_from_id,
+            errors, stream_parser))
     else:
-        cfg.lerror(
-            f"utils.geth_request rcode=={rcode} content={content}")
-        return None
+        for request, error in failed:
+            cfg.lerror(
+                f"geth_request ep={ep} request={request} "
+                f"retries={retries} answer={error}")
+            if errors is not None:
+                errors.append({
+                    'id': request['id'],
+                    'method': request['method'],
+                    'params': request.get('params'),
+                    'error': error,
+                })
+
+    return results
+
+
+def geth_request_multi(
+    ep, requests, retries=5, map_from_id='number', errors=None,
+    stream_parser=None
+):
+    # Items still failing after all retries are left out of the result and
+    #  appended to errors (if provided) as structured errors
+    results = _geth_request_multi(
+        ep, requests, retries, map_from_id, errors, stream_parser)
+    return [
+        results[request['id']] for request in requests
+        if request['id'] in results
+    ]
+
+
+class AsyncRPCClient:
+    # Blocking calls run on a thread pool sized to the in-flight ceiling, so
+    #  the pooled HTTP transport is shared while asyncio does the scheduling.
+    #  The endpoints pool of ep tells the in-flight limit and batch sizes.
+    #  The thread pool and the in-flight count are the ones of the endpoints
+    #  pool, so clients running at the same time (the fetch loop and the
+    #  processor in streaming mode) stay under the limit together
+    def __init__(self, ep):
+        self.ep = ep
+        self.pool = get_pool(ep)
+        self.max_in_flight = cfg.RPC_MAX_IN_FLIGHT * len(self.pool)
+        with _executors_lock:
+            if ep not in _executors:
+                _executors[ep] = ThreadPoolExecutor(
+                    max_workers=self.max_in_flight)
+            self.executor = _executors[ep]
+
+    async def acquire(self):
+        # The controllers move the limit from the worker threads, polling
+        #  is simpler than notifying the loop from there
+        while not self.pool.acquire(self.max_in_flight):
+            await asyncio.sleep(0.01)
+
+    def release(self):
+        self.pool.release()
+
+    async def call_multi(
+        self, requests, map_from_id='number', errors=None, stream_parser=None
+    ):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            partial(
+                geth_request_multi, ep=self.ep, requests=requests,
+                map_from_id=map_from_id, errors=errors,
+                stream_parser=stream_parser
+            )
+        )
+
+
+async def _rpc_fetcher(
+    client, requests, queries_per_request, map_from_id, errors, stream_parser,
+    on_results
+):
+    # Shared work queue: each worker takes the next chunk as soon as it is
+    #  idle, so a slow chunk only delays itself. Chunk size is decided when
+    #  taken, from the current controller batch size for the method.
+    #  on_results gets each chunk as soon as it completes
+    method = requests[0].get('method')
+    cursor = 0
+    results = {}
+
+    async def worker():
+        nonlocal cursor
+        while cursor < len(requests):
+            await client.acquire()
+            try:
+                if cursor >= len(requests):
+                    return
+                start = cursor
+                cursor += client.pool.batch_size(
+                    method, queries_per_request)
+                chunk_requests = requests[start:cursor]
+                results[start] = (
+                    chunk_requests,
+                    await client.call_multi(
+                        chunk_requests, map_from_id, errors, stream_parser)
+                )
+                if on_results:
+                    on_results(*results[start])
+            finally:
+                client.release()
+
+    await asyncio.gather(*(worker() for _ in range(client.max_in_flight)))
+    return [results[start] for start in sorted(results)]
+
+
+def rpc_fetcher(
+    ep, requests, queries_per_request, map_from_id='number', errors=None,
+    stream_parser=None, on_results=None
+):
+    if not requests:
+        return []
+
+    return asyncio.run(_rpc_fetcher(
+        AsyncRPCClient(ep), requests, queries_per_request, map_from_id,
+        errors, stream_parser, on_results))
 
 
 def get_contracts_filename(batches_filename):
@@ -240,103 +657,115 @@ def get_contracts_filename(batches_filename):
     return filename
 
 
-def batch_fetcher(batch_ids):
-    class Fetcher(Thread):
-        def __init__(self, ep, batch_ids):
-            Thread.__init__(self)
-            self.ep = ep
-            self.batch_ids = batch_ids
-            self.batches = []
-
-        def run(self):
-            for chunk_batch_ids in chunks(
-                self.batch_ids, cfg.DOWNLOAD_QUERIES_PER_REQUEST
-            ):
-                self.batches.extend(
-                    geth_request_multi(
-                        ep=ep,
-                        requests=[
-                            {
-                                'method': 'zkevm_getBatchByNumber',
-                                'params': [hex(batch_number), True],
-                                'id': batch_number
-                            }
-                            for batch_number in chunk_batch_ids
-                        ]
-                    )
-                )
-            for batch in self.batches:
-                if not batch.get('transactions'):
-                    batch['transactions'] = []
-
-    ep = cfg.EP
-    threads = []
-    chunk_size = int(
-        math.ceil(len(batch_ids)/cfg.THREAD_COUNT)
-    )
+def slim_tx(tx):
+    receipt = tx.get('receipt') or {}
+    slim = {field: tx.get(field) for field in cfg.TX_SLIM_FIELDS}
+    # Only contract creations need their input (the creation code)
+    if receipt.get('contractAddress'):
+        slim['input'] = tx.get('input')
+    slim['receipt'] = {
+        field: receipt.get(field) for field in cfg.TX_SLIM_RECEIPT_FIELDS
+    }
+    return slim
 
-    for chunk_batch_ids in chunks(batch_ids, chunk_size):
-        t = Fetcher(ep, chunk_batch_ids)
-        t.start()
-        threads.append(t)
 
+def batch_fetcher(batch_ids, errors=None, on_batches=None):
+    # Txs are projected chunk by chunk, as they come. If on_batches is given
+    #  they go there instead, as (batch number, txs) of each completed chunk,
+    #  batches without txs included (txs None if answered with 'method
+    #  handler crashed', empty by error) and failed ones left out
     transactions = []
-    for t in threads:
-        t.join()
-        for _batch in t.batches:
-            transactions.extend(_batch.get('transactions', []))
+    _errors = []
+    _slim = cfg.TX_FIELDS != 'full'
+
+    def _on_results(chunk_requests, _batches):
+        _failed = set(e['id'] for e in _errors)
+        _txs = {
+            _batch['number']: [
+                slim_tx(_tx) if _slim else _tx
+                for _tx in _batch.get('transactions') or []
+            ]
+            for _batch in _batches
+        }
+        on_batches([
+            (_request['id'], _txs.get(_request['id']))
+            for _request in chunk_requests if _request['id'] not in _failed
+        ])
+
+    for _, _batches in rpc_fetcher(
+        ep=cfg.EP_LIST,
+        requests=[
+            {
+                'method': 'zkevm_getBatchByNumber',
+                'params': [hex(batch_number), True],
+                'id': batch_number
+            }
+            for batch_number in batch_ids
+        ],
+        queries_per_request=cfg.DOWNLOAD_QUERIES_PER_REQUEST, errors=_errors,
+        on_results=_on_results if on_batches else None
+    ):
+        if on_batches:
+            continue
+        for _batch in _batches:
+            _txs = _batch.get('transactions') or []
+            transactions.extend(map(slim_tx, _txs) if _slim else _txs)
+
+    if _errors:
+        cfg.lerror(
+            f"batch_fetcher failed batches: {[e['id'] for e in _errors]}")
+        if errors is not None:
+            errors.extend(_errors)
 
     return transactions
 
 
 def get_contract_code(contract_address):
     return geth_request(
-        ep=cfg.EP, method='eth_getCode', params=[contract_address, "latest"]
+        ep=cfg.EP_LIST, method='eth_getCode',
+        params=[contract_address, "latest"]
     )
 
 
-def contract_fetcher(contract_addresses):
-    class Fetcher(Thread):
-        def __init__(self, ep, contract_addresses):
-            Thread.__init__(self)
-            self.ep = ep
-            self.contract_addresses = contract_addresses
-            self.codes = []
+def contract_fetcher(contract_addresses, errors=None):
+    codes = []
+    _errors = []
+    for _, _codes in rpc_fetcher(
+        ep=cfg.EP_LIST,
+        requests=[
+            {
+                'method': 'eth_getCode',
+                'params': [addr, "latest"],
+                'id': addr
+            }
+            for addr in contract_addresses
+        ],
+        queries_per_request=cfg.DOWNLOAD_QUERIES_PER_REQUEST,
+        map_from_id='address', errors=_errors
+    ):
+        codes.extend(_codes)
+
+    if _errors:
+        cfg.lerror(
+            f"contract_fetcher failed addresses: {[e['id'] for e in _errors]}")
+        if errors is not None:
+            errors.extend(_errors)
 
-        def run(self):
-            for chunk_contract_addresses in chunks(
-                self.contract_addresses, cfg.DOWNLOAD_QUERIES_PER_REQUEST
-            ):
-                self.codes.extend(
-                    geth_request_multi(
-                        ep=ep,
-                        requests=[
-                            {
-                                'method': 'eth_getCode',
-                                'params': [addr, "latest"],
-                                'id': addr
-                            }
-                            for addr in chunk_contract_addresses
-                        ],
-                        map_from_id='address'
-                    )
-                )
+    return codes
 
-    ep = cfg.EP
-    threads = []
-    chunk_size = int(
-        math.ceil(len(contract_addresses)/cfg.THREAD_COUNT)
-    )
 
-    for chunk_contract_addresses in chunks(contract_addresses, chunk_size):
-        t = Fetcher(ep, chunk_contract_addresses)
-        t.start()
-        threads.append(t)
+def resolve_contract_codes(contract_addresses):
+    codes = {}
+    if not contract_addresses:
+        return codes
 
-    codes = []
-    for t in threads:
-        t.join()
-        codes.extend(t.codes)
+    for _code in contract_fetcher(contract_addresses):
+        codes[_code.get('address')] = _code.get('result')
+
+    # Whatever could not be resolved in batches goes one by one
+    for addr in contract_addresses:
+        if addr not in codes:
+            codes[addr] = get_contract_code(addr)
 
     return codes
 
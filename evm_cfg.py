@@ -0,0 +1,125 @@
+from evm_opcodes import OPCODE_NAMES, OPCODE_HEX, PUSH_WIDTHS
+
+UNREACHABLE = 'unreachable'
+UNKNOWN = 'unknown'
+REACHABLE = 'reachable'
+_CLASSES = (UNREACHABLE, UNKNOWN, REACHABLE)
+
+JUMP = 0x56
+JUMPI = 0x57
+JUMPDEST = 0x5b
+PUSH0 = 0x5f
+
+# Opcodes ending execution, undefined ones included (they act as INVALID)
+HALTS = frozenset(
+    value for value in range(256)
+    if value not in OPCODE_NAMES or value in (0x00, 0xf3, 0xfd, 0xfe, 0xff)
+)
+
+# First key of the CBOR map the compilers append to the runtime
+METADATA_KEYS = (b'ipfs', b'bzzr0', b'bzzr1', b'solc', b'experimental',
+                 b'vyper')
+
+
+def metadata_start(code):
+    # Solidity (and Vyper) end the runtime with a CBOR map followed by its
+    #  length in 2 bytes. Returns where it starts, or the code length
+    size = len(code)
+    if size < 2:
+        return size
+    start = size - 2 - int.from_bytes(code[-2:], 'big')
+    if start < 0 or start + 2 >= size or not 0xa1 <= code[start] <= 0xa5:
+        return size
+    key_size = code[start + 1] - 0x60
+    if 0 < key_size < 24 and \
+            code[start + 2:start + 2 + key_size] in METADATA_KEYS:
+        return start
+    return size
+
+
+def _blocks(code, end):
+    # Basic blocks of the code until end, as lists:
+    #  [opcodes, falls through, jump target (-1 none, None dynamic)].
+    #  A new block starts on each JUMPDEST and after a jump or a halt
+    blocks = []
+    jumpdests = {}
+    block = None
+    widths = PUSH_WIDTHS
+    pushed = None
+    pc = 0
+    while pc < end:
+        opcode = code[pc]
+        width = widths[opcode]
+        if block is None or opcode == JUMPDEST:
+            block = [[], True, -1]
+            if opcode == JUMPDEST:
+                jumpdests[pc] = len(blocks)
+            blocks.append(block)
+        block[0].append(opcode)
+        if opcode == JUMP or opcode == JUMPI:
+            block[1] = opcode == JUMPI
+            block[2] = pushed
+            block = None
+        elif opcode in HALTS:
+            block[1] = False
+            block = None
+        # Static jumps take the target from the push right before them
+        if width:
+            pushed = int.from_bytes(code[pc + 1:pc + 1 + width], 'big')
+        elif opcode == PUSH0:
+            pushed = 0
+        else:
+            pushed = None
+        pc += 1 + width
+    return blocks, jumpdests, pc
+
+
+def _visit(blocks, jumpdests, dynamic):
+    # Blocks reached from the entry. Dynamic jumps are followed to every
+    #  JUMPDEST if asked, they are ignored otherwise
+    seen = [False] * len(blocks)
+    pending = [0] if blocks else []
+    while pending:
+        index = pending.pop()
+        if seen[index]:
+            continue
+        seen[index] = True
+        _, falls, target = blocks[index]
+        if falls and index + 1 < len(blocks):
+            pending.append(index + 1)
+        if target is None:
+            if dynamic:
+                pending.extend(jumpdests.values())
+                dynamic = False
+        elif target in jumpdests:
+            pending.append(jumpdests[target])
+    return seen
+
+
+def opcode_reachability(code):
+    # Class of each opcode found by a linear scan (as count_opcodes does):
+    #  reachable through static jumps, unknown when only a dynamic jump
+    #  could get there, or unreachable (dead code, data, metadata)
+    end = metadata_start(code)
+    blocks, jumpdests, pc = _blocks(code, end)
+    static = _visit(blocks, jumpdests, False)
+    maybe = _visit(blocks, jumpdests, True)
+
+    best = [-1] * 256
+    for index, (opcodes, _, _) in enumerate(blocks):
+        rank = 2 if static[index] else 1 if maybe[index] else 0
+        for opcode in opcodes:
+            if best[opcode] < rank:
+                best[opcode] = rank
+
+    size = len(code)
+    while pc < size:
+        opcode = code[pc]
+        if best[opcode] < 0:
+            best[opcode] = 0
+        pc += 1 + PUSH_WIDTHS[opcode]
+
+    return {
+        OPCODE_HEX[opcode]: _CLASSES[rank]
+        for opcode, rank in enumerate(best) if rank >= 0
+    }
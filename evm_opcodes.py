@@ -0,0 +1,80 @@
+OPCODE_NAMES = {
+    0x00: 'STOP', 0x01: 'ADD', 0x02: 'MUL', 0x03: 'SUB', 0x04: 'DIV',
+    0x05: 'SDIV', 0x06: 'MOD', 0x07: 'SMOD', 0x08: 'ADDMOD', 0x09: 'MULMOD',
+    0x0a: 'EXP', 0x0b: 'SIGNEXTEND',
+    0x10: 'LT', 0x11: 'GT', 0x12: 'SLT', 0x13: 'SGT', 0x14: 'EQ',
+    0x15: 'ISZERO', 0x16: 'AND', 0x17: 'OR', 0x18: 'XOR', 0x19: 'NOT',
+    0x1a: 'BYTE', 0x1b: 'SHL', 0x1c: 'SHR', 0x1d: 'SAR', 0x1e: 'CLZ',
+    0x20: 'KECCAK256',
+    0x30: 'ADDRESS', 0x31: 'BALANCE', 0x32: 'ORIGIN', 0x33: 'CALLER',
+    0x34: 'CALLVALUE', 0x35: 'CALLDATALOAD', 0x36: 'CALLDATASIZE',
+    0x37: 'CALLDATACOPY', 0x38: 'CODESIZE', 0x39: 'CODECOPY',
+    0x3a: 'GASPRICE', 0x3b: 'EXTCODESIZE', 0x3c: 'EXTCODECOPY',
+    0x3d: 'RETURNDATASIZE', 0x3e: 'RETURNDATACOPY', 0x3f: 'EXTCODEHASH',
+    0x40: 'BLOCKHASH', 0x41: 'COINBASE', 0x42: 'TIMESTAMP', 0x43: 'NUMBER',
+    0x44: 'DIFFICULTY', 0x45: 'GASLIMIT', 0x46: 'CHAINID',
+    0x47: 'SELFBALANCE', 0x48: 'BASEFEE', 0x49: 'BLOBHASH',
+    0x4a: 'BLOBBASEFEE',
+    0x50: 'POP', 0x51: 'MLOAD', 0x52: 'MSTORE', 0x53: 'MSTORE8',
+    0x54: 'SLOAD', 0x55: 'SSTORE', 0x56: 'JUMP', 0x57: 'JUMPI', 0x58: 'PC',
+    0x59: 'MSIZE', 0x5a: 'GAS', 0x5b: 'JUMPDEST', 0x5c: 'TLOAD',
+    0x5d: 'TSTORE', 0x5e: 'MCOPY', 0x5f: 'PUSH0',
+    0xf0: 'CREATE', 0xf1: 'CALL', 0xf2: 'CALLCODE', 0xf3: 'RETURN',
+    0xf4: 'DELEGATECALL', 0xf5: 'CREATE2', 0xfa: 'STATICCALL',
+    0xfd: 'REVERT', 0xfe: 'INVALID', 0xff: 'SELFDESTRUCT',
+}
+OPCODE_NAMES.update({0x60 + i: f'PUSH{i + 1}' for i in range(32)})
+OPCODE_NAMES.update({0x80 + i: f'DUP{i + 1}' for i in range(16)})
+OPCODE_NAMES.update({0x90 + i: f'SWAP{i + 1}' for i in range(16)})
+OPCODE_NAMES.update({0xa0 + i: f'LOG{i}' for i in range(5)})
+
+OPCODE_VALUES = {name: value for value, name in OPCODE_NAMES.items()}
+OPCODE_HEX = tuple(f'{value:02x}' for value in range(256))
+
+# Immediate bytes following each opcode, only PUSH1..PUSH32 have them
+PUSH_WIDTHS = bytes(
+    value - 0x5f if 0x60 <= value <= 0x7f else 0 for value in range(256))
+
+
+def count_opcodes(code):
+    # Occurrences of each opcode value (list of 256) in the bytecode, push
+    #  immediates skipped. A truncated push at the end still counts
+    counts = [0] * 256
+    widths = PUSH_WIDTHS
+    size = len(code)
+    pc = 0
+    while pc < size:
+        opcode = code[pc]
+        counts[opcode] += 1
+        pc += 1 + widths[opcode]
+    return counts
+
+
+def opcodes_to_mask(names):
+    # 256-bit mask with a bit per known opcode name. Names we do not know
+    #  (or aliases like SHA3/PREVRANDAO) are returned apart, unchanged
+    mask = 0
+    extra = []
+    for name in names:
+        value = OPCODE_VALUES.get(name)
+        if value is None:
+            extra.append(name)
+        else:
+            mask |= 1 << value
+    return mask, extra
+
+
+def hex_to_mask(opcodes):
+    # 256-bit mask with a bit per opcode given in hex ('5c', 'ff', ...)
+    mask = 0
+    for opcode in opcodes:
+        mask |= 1 << int(opcode, 16)
+    return mask
+
+
+def mask_to_opcodes(mask, extra=()):
+    names = [
+        OPCODE_NAMES[value] for value in range(256)
+        if mask >> value & 1
+    ]
+    return names + list(extra)
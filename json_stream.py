@@ -0,0 +1,116 @@
+import codecs
+import json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+class JSONStream:
+    # Pull parser over an iterator of byte chunks. Only the structure we
+    #  walk through is parsed by hand, any other value is decoded at once
+    #  with the stdlib decoder, so just one value is kept in memory
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+
+    def _more(self):
+        for chunk in self.chunks:
+            text = self.utf8.decode(chunk)
+            if text:
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and \
+                    self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(
+                f"Expected {char!r} at {self.buf[self.pos:self.pos + 20]!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._more():
+                    raise
+                continue
+            # A number at the end of the buffer could go on in the next chunk
+            if end == len(self.buf) and self._more():
+                continue
+            self.pos = end
+            return value
+
+    def _container(self, opening, closing):
+        self.expect(opening)
+        if self.peek() == closing:
+            self.pos += 1
+            return
+        while True:
+            yield
+            separator = self.peek()
+            self.pos += 1
+            if separator == closing:
+                return
+            if separator != ',':
+                raise ValueError(f"Unexpected {separator!r} in JSON stream")
+
+    def keys(self):
+        # The caller must read the value of each key before the next one
+        for _ in self._container('{', '}'):
+            key = self.value()
+            self.expect(':')
+            yield key
+
+    def elements(self):
+        # The caller must read each element before the next one
+        return self._container('[', ']')
+
+
+def _reduce_trace(stream):
+    trace = {}
+    for key in stream.keys():
+        if key == 'structLogs' and stream.peek() == '[':
+            opcodes = set()
+            for _ in stream.elements():
+                opcodes.add(stream.value().get('op'))
+            trace['opcodes'] = list(opcodes)
+        else:
+            trace[key] = stream.value()
+    return trace
+
+
+def reduce_traces(chunks):
+    # Batch answer of debug_traceTransaction with each structLogs reduced to
+    #  its set of opcodes while reading, steps are dropped once seen
+    stream = JSONStream(chunks)
+    if stream.peek() != '[':
+        return stream.value()
+
+    answers = []
+    for _ in stream.elements():
+        if stream.peek() != '{':
+            answers.append(stream.value())
+            continue
+        answer = {}
+        for key in stream.keys():
+            if key == 'result' and stream.peek() == '{':
+                answer[key] = _reduce_trace(stream)
+            else:
+                answer[key] = stream.value()
+        answers.append(answer)
+    return answers
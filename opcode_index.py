@@ -0,0 +1,109 @@
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+import config as cfg
+
+# Inverted index from opcode to the contracts having it, one file:
+#  header | contracts (address, tx_count) | 257 offsets | posting lists.
+#  Contract ids follow the tx_count (most used first), so posting lists
+#  sorted by id are ranked already and a tx_count filter is an id range
+_MAGIC = b'OPX1'
+_HEADER = struct.Struct('<4sQ')
+_CONTRACT = struct.Struct('<20sQ')
+_OFFSETS = struct.Struct('<257Q')
+
+
+def write_index(filename, contracts):
+    # contracts: (address, tx_count, opcode values) in any order
+    contracts = sorted(contracts, key=lambda c: -c[1])
+    postings = [array('I') for _ in range(256)]
+    for _id, (_, _, values) in enumerate(contracts):
+        for value in values:
+            postings[value].append(_id)
+
+    offsets = [0]
+    for posting in postings:
+        offsets.append(offsets[-1] + len(posting))
+
+    Path(os.path.dirname(filename) or '.').mkdir(parents=True, exist_ok=True)
+    cfg.linfo(f"Saving opcode index to {filename}")
+    # Written aside and renamed, a reader never sees half an index
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(contracts)))
+        for address, tx_count, _ in contracts:
+            f.write(_CONTRACT.pack(bytes.fromhex(address[2:]), tx_count))
+        f.write(_OFFSETS.pack(*offsets))
+        for posting in postings:
+            if posting:
+                f.write(posting.tobytes())
+    os.replace(filename + '.tmp', filename)
+
+
+def read_index(filename):
+    # (address, tx_count, opcode values) of each contract, as given to
+    #  write_index, so the analyzer can update some of them
+    index = OpcodeIndex(filename)
+    try:
+        values = [[] for _ in range(len(index))]
+        for value in range(256):
+            for _id in index.postings(value).tolist():
+                values[_id].append(value)
+        return [
+            (*index.contract(_id), values[_id]) for _id in range(len(index))
+        ]
+    finally:
+        index.close()
+
+
+class OpcodeIndex:
+    # Memory-mapped reader, only the posting lists queried are read
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = _HEADER.unpack_from(self.mm, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{filename} is not an opcode index")
+        self._contracts_start = _HEADER.size
+        offsets_start = self._contracts_start + self.count * _CONTRACT.size
+        self.offsets = _OFFSETS.unpack_from(self.mm, offsets_start)
+        self._postings_start = offsets_start + _OFFSETS.size
+
+    def __len__(self):
+        return self.count
+
+    def contract(self, _id):
+        # (address, tx_count) of a contract id
+        address, tx_count = _CONTRACT.unpack_from(
+            self.mm, self._contracts_start + _id * _CONTRACT.size)
+        return '0x' + address.hex(), tx_count
+
+    def tx_count(self, _id):
+        return self.contract(_id)[1]
+
+    def postings(self, value):
+        # Ids of the contracts with the opcode, ascending (best ranked first)
+        start = self._postings_start + self.offsets[value] * 4
+        end = self._postings_start + self.offsets[value + 1] * 4
+        return memoryview(self.mm)[start:end].cast('I')
+
+    def tx_count_range(self, operator, value):
+        # Ids with tx_count <operator> value, as a range of ids
+        key = self.tx_count
+        ids = range(self.count)
+        # tx_count decreases with the id, search on its negative
+        first = bisect_left(ids, -value, key=lambda _id: -key(_id))
+        last = bisect_right(ids, -value, key=lambda _id: -key(_id))
+        return {
+            '>': range(0, first),
+            '>=': range(0, last),
+            '==': range(first, last),
+            '<=': range(first, self.count),
+            '<': range(last, self.count),
+        }[operator]
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+import os
+import sys
+import config as cfg
+from time import time
+from downloader_helper import _dumper
+from evm_opcodes import hex_to_mask
+from storage import ContractStore
+
+# Conflicts for the opcode profiles of config.py (all of them if none is
+#  given) from the runtime masks kept by 2_analyzer, without scanning them:
+#  ENV=cardona ./opcode_profile.py cancun osaka
+
+output_folder = cfg.OUTPUT_FOLDER
+contracts_db = cfg.CONTRACTS_DB
+profile_conflicts_file = cfg.PROFILE_CONFLICTS_FILE
+
+global_start_time = time()
+
+profiles = sys.argv[1:] or list(cfg.OPCODE_PROFILES)
+for _profile in profiles:
+    if _profile not in cfg.OPCODE_PROFILES:
+        print(
+            f"Unknown profile {_profile}, "
+            f"available: {', '.join(cfg.OPCODE_PROFILES)}")
+        sys.exit(1)
+
+store = ContractStore(os.path.join(output_folder, contracts_db))
+_not_analyzed = len(store.missing_opcodes())
+if _not_analyzed:
+    print(f"{_not_analyzed} runtimes not analyzed yet, run 2_analyzer.py")
+
+start_time = time()
+masks = list(store.iter_masks())
+contracts = list(store.iter_contracts())
+print(
+    f"Loaded {len(masks)} runtime masks and {len(contracts)} contracts "
+    f"in {time() - start_time:.2f} seconds"
+)
+
+for _profile in profiles:
+    start_time = time()
+    _unsupported = cfg.OPCODE_PROFILES[_profile]['unsupported']
+    _changed = cfg.OPCODE_PROFILES[_profile]['changed']
+    _profile_mask = hex_to_mask(_unsupported + _changed)
+
+    # Runtimes with any opcode of the profile (where it may be reachable)
+    _matches = {}
+    for _code_hash, mask, reachable_mask in masks:
+        _found = _profile_mask & \
+            (reachable_mask if cfg.REACHABILITY_FILTER else mask)
+        if _found:
+            _matches[_code_hash] = _found
+
+    conflicts = {_opcode: {} for _opcode in _unsupported + _changed}
+    for address, _call_count, _code_hash in contracts:
+        _found = _matches.get(_code_hash)
+        if not _found:
+            continue
+        for _opcode in conflicts:
+            if _found >> int(_opcode, 16) & 1:
+                conflicts[_opcode][address] = None
+    print(
+        f"Profile {_profile}: {len(_matches)} runtimes, "
+        f"{len(set().union(*conflicts.values()))} contracts "
+        f"in {time() - start_time:.3f} seconds"
+    )
+
+    # Same as 2_analyzer: failed txs for unsupported opcodes, successful
+    #  txs for changed ones, contracts without them are left out
+    for _opcode, _contracts in conflicts.items():
+        _success = _opcode in _changed
+        for _addr in list(_contracts):
+            _txs = store.contract_txs(_addr, success=_success)
+            if _txs:
+                _contracts[_addr] = _txs
+            else:
+                del _contracts[_addr]
+        print(
+            f"\tOpcode {_opcode}: {len(_contracts)} contracts, "
+            f"{sum(len(v) for v in _contracts.values())} txs"
+        )
+
+    _dumper(
+        conflicts, output_folder,
+        profile_conflicts_file.format(profile=_profile))
+
+store.close()
+
+global_total_time = time() - global_start_time
+print(f"Total time: {global_total_time:.2f} seconds")
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+import argparse
+import os
+import re
+import sys
+import config as cfg
+from time import time
+from evm_opcodes import OPCODE_VALUES
+from opcode_index import OpcodeIndex
+
+# Contracts matching a boolean opcode expression, from the opcode index of
+#  2_analyzer, most used first:
+#  ENV=cardona ./opcode_query.py "TSTORE and not TLOAD"
+#  ENV=cardona ./opcode_query.py "SELFDESTRUCT with tx_count > 100"
+# Operators are lowercase (and/with, or, not, parentheses), opcodes are
+#  uppercase names (so AND, OR, NOT are the opcodes) or hex like 0x5c
+
+ALIASES = {'SHA3': 0x20, 'PREVRANDAO': 0x44}
+_TOKENS = re.compile(r'\s*(\(|\)|>=|<=|==|>|<|[A-Za-z0-9_]+)')
+
+
+def tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = _TOKENS.match(expression, pos)
+        if not match:
+            raise ValueError(f"Unexpected {expression[pos:]!r}")
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+class Query:
+    # Recursive descent over the tokens, evaluated to sets of contract ids:
+    #  expr = term (or term)*, term = factor (and|with factor)*,
+    #  factor = not factor | ( expr ) | tx_count <op> n | opcode
+    def __init__(self, index, expression):
+        self.index = index
+        self.tokens = tokenize(expression)
+        self.pos = 0
+
+    def run(self):
+        result = self.expr()
+        if self.pos < len(self.tokens):
+            raise ValueError(f"Unexpected {self.tokens[self.pos]!r}")
+        return result
+
+    def _next(self):
+        if self.pos >= len(self.tokens):
+            raise ValueError("Unexpected end of expression")
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def expr(self):
+        result = self.term()
+        while self._peek() == 'or':
+            self.pos += 1
+            result = result | self.term()
+        return result
+
+    def term(self):
+        result = self.factor()
+        while self._peek() in ('and', 'with'):
+            self.pos += 1
+            result = result & self.factor()
+        return result
+
+    def factor(self):
+        token = self._next()
+        if token == 'not':
+            return set(range(len(self.index))) - self.factor()
+        if token == '(':
+            result = self.expr()
+            if self._next() != ')':
+                raise ValueError("Missing ')'")
+            return result
+        if token == 'tx_count':
+            operator = self._next()
+            value = self._next()
+            if operator not in ('>', '>=', '==', '<=', '<') or \
+                    not value.isdigit():
+                raise ValueError(f"Invalid tx_count {operator} {value}")
+            return set(self.index.tx_count_range(operator, int(value)))
+        return set(self.index.postings(opcode_value(token)))
+
+
+def opcode_value(token):
+    if token.startswith('0x'):
+        value = int(token, 16)
+        if value > 0xff:
+            raise ValueError(f"Invalid opcode {token}")
+        return value
+    if token in OPCODE_VALUES:
+        return OPCODE_VALUES[token]
+    if token in ALIASES:
+        return ALIASES[token]
+    raise ValueError(f"Unknown opcode {token}")
+
+
+parser = argparse.ArgumentParser(description="Query the opcode index")
+parser.add_argument('expression', nargs='+')
+parser.add_argument(
+    '--limit', type=int, default=50, help="contracts listed, 0 for all")
+parser.add_argument(
+    '--count', action='store_true', help="only count the contracts")
+args = parser.parse_args()
+
+start_time = time()
+index = OpcodeIndex(os.path.join(cfg.OUTPUT_FOLDER, cfg.OPCODE_INDEX_FILE))
+try:
+    ids = Query(index, ' '.join(args.expression)).run()
+except ValueError as e:
+    print(f"Invalid query: {e}")
+    sys.exit(1)
+
+if not args.count:
+    ids = sorted(ids)
+    for _id in ids[:args.limit] if args.limit else ids:
+        address, tx_count = index.contract(_id)
+        print(f"{address} {tx_count}")
+print(
+    f"Contracts: {len(ids)} of {len(index)} "
+    f"| Time: {time() - start_time:.3f} seconds"
+)
+index.close()
@@ -0,0 +1,246 @@
+import random
+from threading import Lock
+from time import time
+import config as cfg
+
+_controllers = {}
+_controllers_lock = Lock()
+_pools = {}
+
+
+class AdaptiveController:
+    # AIMD over the endpoint: in-flight requests and batch sizes grow
+    #  additively while the node answers fast, and are cut by half when it
+    #  throttles us or fails
+    def __init__(self, ep):
+        self.ep = ep
+        self.lock = Lock()
+        self.adaptive = cfg.RPC_ADAPTIVE
+        self._in_flight = float(
+            cfg.RPC_INITIAL_IN_FLIGHT if self.adaptive
+            else cfg.RPC_MAX_IN_FLIGHT)
+        self._batch_sizes = {}
+        self._max_batch_sizes = {}
+        self.latency = None
+        self.throttled = 0
+        self.errors = 0
+        self.item_errors = 0
+        self.consecutive_throttles = 0
+        # Health: recent failure rate (errors, throttles and items answered
+        #  with an error), and down for a while after too many failures in a
+        #  row
+        self.failure_rate = 0.0
+        self.consecutive_failures = 0
+        self.down_until = 0
+
+    def in_flight(self):
+        return int(self._in_flight)
+
+    def batch_size(self, method, default):
+        with self.lock:
+            if method not in self._batch_sizes:
+                self._batch_sizes[method] = float(default)
+                self._max_batch_sizes[method] = \
+                    default * cfg.RPC_MAX_BATCH_FACTOR
+            if not self.adaptive:
+                return default
+            return int(self._batch_sizes[method])
+
+    def _scale_batch(self, method, factor):
+        if method in self._batch_sizes:
+            self._batch_sizes[method] = min(
+                self._max_batch_sizes[method],
+                max(1.0, self._batch_sizes[method] * factor)
+            )
+
+    def record(self, method, n_items, rcode, latency, size, failed_items=0):
+        with self.lock:
+            self.latency = latency if self.latency is None \
+                else 0.8 * self.latency + 0.2 * latency
+
+            if rcode == 429:
+                self.throttled += 1
+                self.consecutive_throttles += 1
+            elif rcode is None or rcode >= 500:
+                self.errors += 1
+            else:
+                self.consecutive_throttles = 0
+
+            # A node answering 200 with an error on every item failed too,
+            #  some items with an error count as that fraction of a failure
+            self.item_errors += failed_items
+            all_failed = n_items and failed_items >= n_items
+            failed = rcode is None or rcode == 429 or rcode >= 500
+            failure = 1.0 if failed or all_failed \
+                else failed_items / max(1, n_items)
+            self.failure_rate = 0.8 * self.failure_rate + 0.2 * failure
+            failed = failed or all_failed
+            if not failed:
+                self.consecutive_failures = 0
+            else:
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= cfg.RPC_EP_MAX_FAILURES:
+                    self.down_until = time() + cfg.RPC_EP_DOWN_COOLDOWN
+
+            if not self.adaptive:
+                return
+
+            if rcode == 429:
+                self._in_flight = max(1.0, self._in_flight / 2)
+            elif rcode is None or rcode >= 500:
+                # Large batches are a usual reason for the node to fail
+                self._in_flight = max(1.0, self._in_flight / 2)
+                self._scale_batch(method, 0.5)
+            elif all_failed:
+                # An answer without results tells nothing about the sizes
+                return
+            elif latency > cfg.RPC_TARGET_LATENCY or \
+                    size > cfg.RPC_MAX_RESPONSE_BYTES:
+                self._scale_batch(method, 0.75)
+            else:
+                self._in_flight = min(
+                    float(cfg.RPC_MAX_IN_FLIGHT),
+                    self._in_flight + 1 / self._in_flight
+                )
+                # Only full batches tell us the current size is fine
+                _size = self._batch_sizes.get(method)
+                if _size and n_items >= int(_size):
+                    self._scale_batch(method, 1 + 1 / _size)
+
+    def health(self):
+        # 0 while down, otherwise from 1 (answering fine, under the target
+        #  latency) down to 0.01 as it fails or slows down
+        if time() < self.down_until:
+            return 0
+        health = 1 - self.failure_rate
+        if self.latency and self.latency > cfg.RPC_TARGET_LATENCY:
+            health *= cfg.RPC_TARGET_LATENCY / self.latency
+        return max(0.01, health)
+
+    def throttle_cooldown(self):
+        # Exponential backoff on consecutive throttles, reset on success
+        return min(
+            cfg.RPC_THROTTLE_COOLDOWN_MAX,
+            cfg.RPC_THROTTLE_COOLDOWN * 2 ** max(
+                0, self.consecutive_throttles - 1)
+        )
+
+    def __str__(self):
+        batch_sizes = {k: int(v) for k, v in self._batch_sizes.items()}
+        latency = f"{self.latency:.2f}s" if self.latency is not None \
+            else "-"
+        return \
+            f"ep={self.ep} in_flight={self.in_flight()} " \
+            f"batch_sizes={batch_sizes} latency={latency} " \
+            f"throttled={self.throttled} errors={self.errors} " \
+            f"item_errors={self.item_errors} " \
+            f"health={self.health():.2f}"
+
+
+class EndpointPool:
+    # Endpoints of a role (EP_LIST for reads, EP_DEBUG_LIST for traces).
+    #  Each request goes to one picked at random by weight times health, so
+    #  a failing, throttling or slow node gets less of them, none while it
+    #  is down (unless all of them are). Each endpoint has its controller
+    def __init__(self, endpoints):
+        self.endpoints = [ep for ep, _ in endpoints]
+        self.weights = [weight for _, weight in endpoints]
+        self.controllers = [get_controller(ep) for ep in self.endpoints]
+        # Requests in flight over the pool, from every client using it
+        self.lock = Lock()
+        self.active = 0
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def pick(self, exclude=None):
+        # exclude: endpoint that just failed, for a failover
+        candidates = [
+            (ep, weight * controller.health(), controller)
+            for ep, weight, controller in zip(
+                self.endpoints, self.weights, self.controllers)
+            if ep != exclude
+        ] or [
+            (ep, 0, controller)
+            for ep, controller in zip(self.endpoints, self.controllers)
+        ]
+        if not any(score for _, score, _ in candidates):
+            # All down, the first to come back up is tried
+            return min(candidates, key=lambda c: c[2].down_until)[0]
+        return random.choices(
+            [ep for ep, _, _ in candidates],
+            weights=[score for _, score, _ in candidates]
+        )[0]
+
+    def up(self, exclude=None):
+        # If any endpoint (other than exclude) is up
+        return any(
+            controller.health()
+            for ep, controller in zip(self.endpoints, self.controllers)
+            if ep != exclude
+        )
+
+    def in_flight(self):
+        # Sum of the endpoints up
+        return max(1, sum(
+            controller.in_flight() for controller in self.controllers
+            if controller.health()
+        ))
+
+    def acquire(self, limit):
+        # Takes an in-flight slot if there is one under limit
+        with self.lock:
+            if self.active >= min(limit, self.in_flight()):
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    def batch_size(self, method, default):
+        # A chunk can go to any endpoint, their batch sizes are averaged by
+        #  the share of requests they get
+        sizes = [
+            (controller.batch_size(method, default),
+             weight * controller.health())
+            for weight, controller in zip(self.weights, self.controllers)
+        ]
+        total = sum(score for _, score in sizes)
+        if not total:
+            return min(size for size, _ in sizes)
+        return max(1, int(sum(size * score for size, score in sizes) / total))
+
+
+def get_controller(ep):
+    with _controllers_lock:
+        if ep not in _controllers:
+            _controllers[ep] = AdaptiveController(ep)
+        return _controllers[ep]
+
+
+def controllers():
+    with _controllers_lock:
+        return list(_controllers.values())
+
+
+def parse_endpoints(value):
+    # "url|weight,url,..." as [(url, weight)], weight 1 if not given
+    endpoints = []
+    for item in value.split(','):
+        url, _, weight = item.strip().partition('|')
+        if url:
+            endpoints.append((url, float(weight or 1)))
+    return endpoints
+
+
+def get_pool(ep):
+    # ep: an endpoint, or a list of them as in EP_LIST
+    with _controllers_lock:
+        pool = _pools.get(ep)
+    if pool is None:
+        pool = EndpointPool(parse_endpoints(ep))
+        with _controllers_lock:
+            pool = _pools.setdefault(ep, pool)
+    return pool
@@ -0,0 +1,163 @@
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import re
+from pathlib import Path
+import config as cfg
+
+# Transactions files ("shards") of a range of batches. NDJSON, one tx per
+#  line, read back one tx at a time. Former json array files are still read
+SHARD_RE = re.compile(
+    r"^from_batch_(\d+)_to_(\d+)\.(json|ndjson|ndjson\.gz|ndjson\.xz)$")
+EXTENSIONS = {
+    'gz': '.ndjson.gz',
+    'xz': '.ndjson.xz',
+    'ndjson': '.ndjson',
+    'json': '.json',
+}
+
+
+def shard_name(first_batch, last_batch, shard_format=None):
+    extension = EXTENSIONS[shard_format or cfg.TX_SHARD_FORMAT]
+    return f"from_batch_{first_batch:010}_to_{last_batch:010}{extension}"
+
+
+def shard_batches(name):
+    # (first batch, last batch) of a shard file name
+    match = SHARD_RE.match(name)
+    return int(match.group(1)), int(match.group(2))
+
+
+def list_shards(folder):
+    # Shard file names of the folder, sorted by batch
+    if not os.path.exists(folder):
+        return []
+    return sorted(
+        (name for name in os.listdir(folder) if SHARD_RE.match(name)),
+        key=shard_batches
+    )
+
+
+def partial_shards(folder):
+    # Hidden shards write_shard did not get to rename, left by a killed run
+    if not os.path.exists(folder):
+        return []
+    return sorted(
+        name for name in os.listdir(folder)
+        if name.startswith('.') and SHARD_RE.match(name[1:])
+    )
+
+
+def _shard_rank(name, known):
+    # Which of the shards of the same batches to keep: the one in known
+    #  (the manifest), then the newest format
+    extension = '.' + SHARD_RE.match(name).group(3)
+    extensions = [
+        EXTENSIONS[shard_format]
+        for shard_format in [cfg.TX_SHARD_FORMAT] + list(EXTENSIONS)
+    ]
+    return name not in known, extensions.index(extension)
+
+
+def contained_shards(names, known=()):
+    # Shards (of a sorted list) whose batches are all in another one, as
+    #  left by a run killed after writing a longer shard and before removing
+    #  the shorter one it replaces. Of the shards with the same batches
+    #  (killed while converting them) all but one are in
+    contained = []
+    kept = {}
+    for name in names:
+        batches = shard_batches(name)
+        if batches in kept:
+            keep, drop = sorted(
+                (kept[batches], name), key=lambda n: _shard_rank(n, known))
+            kept[batches] = keep
+            contained.append(drop)
+        else:
+            kept[batches] = name
+    ranges = sorted(kept)
+    widest = None
+    for _i, (first, last) in enumerate(ranges):
+        after = ranges[_i + 1] if _i + 1 < len(ranges) else None
+        if (widest and widest[1] >= last) or \
+                (after and after[0] == first and after[1] > last):
+            contained.append(kept[(first, last)])
+        if widest is None or last > widest[1]:
+            widest = (first, last)
+    return sorted(contained, key=shard_batches)
+
+
+def _open(filename, mode):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', compresslevel=6)
+    if filename.endswith('.xz'):
+        return lzma.open(filename, mode + 't')
+    return open(filename, mode)
+
+
+class _HashingFile(io.RawIOBase):
+    # Passes the bytes written on to f, hashing them as utils.file_hash
+    #  would read them back
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.f.write(data)
+
+
+def _open_hashed(raw, filename):
+    # Text writer over raw, compressed as _open does for filename
+    if filename.endswith('.gz'):
+        f = gzip.GzipFile(
+            filename=filename, mode='wb', compresslevel=6, fileobj=raw)
+    elif filename.endswith('.xz'):
+        f = lzma.LZMAFile(raw, 'wb')
+    else:
+        f = io.BufferedWriter(raw)
+    return io.TextIOWrapper(f, encoding='utf-8')
+
+
+def write_shard(txs, output_folder, name):
+    # Written aside (hidden, not listed) and renamed, so a shard is there
+    #  complete or not at all. Returns the hash of the file, taken as it is
+    #  written
+    Path(output_folder).mkdir(parents=True, exist_ok=True)
+    filename = os.path.join(output_folder, name)
+    partial_filename = os.path.join(output_folder, '.' + name)
+    cfg.linfo(f"Saving {len(txs)} txs to {filename}")
+    with open(partial_filename, 'wb') as raw:
+        hashing = _HashingFile(raw)
+        with _open_hashed(hashing, partial_filename) as f:
+            if name.endswith('.json'):
+                json.dump(txs, f, indent=2)
+            else:
+                for tx in txs:
+                    f.write(json.dumps(tx, separators=(',', ':')))
+                    f.write('\n')
+    os.replace(partial_filename, filename)
+    return hashing.hash.hexdigest()
+
+
+def iter_shard(filename):
+    # Txs of a shard, one at a time
+    count = 0
+    with _open(filename, 'r') as f:
+        if filename.endswith('.json'):
+            # Former format, a json array that has to be loaded at once
+            txs = json.load(f)
+            yield from txs
+            count = len(txs)
+        else:
+            for line in f:
+                if line.strip():
+                    count += 1
+                    yield json.loads(line)
+    cfg.ldebug(f"Read {count} txs from {filename}")
@@ -0,0 +1,852 @@
+import json
+import os
+import sqlite3
+import zlib
+from array import array
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+from time import time
+from evm_opcodes import opcodes_to_mask, mask_to_opcodes, hex_to_mask
+from evm_cfg import UNREACHABLE
+from utils import chunks, code_hash
+import config as cfg
+
+SQL_VARIABLES_PER_QUERY = 500
+MISSING_BATCH = 0xffffffff  # Tx count of a batch that could not be fetched
+# Tx count of a batch the node answered with 'method handler crashed', taken
+#  as empty but asked again on repair
+EMPTY_BY_ERROR = 0xfffffffe
+
+
+def _connect(filename, **kwargs):
+    Path(os.path.dirname(filename) or '.').mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(filename, **kwargs)
+    # WAL + NORMAL sync: commits are atomic and survive a killed process
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class TraceCache:
+    # Executed opcodes of each traced tx, as a 256-bit mask (32 bytes blob)
+    #  plus any opcode name not in our table, appended as txs get traced
+    def __init__(self, filename, legacy_filename=None):
+        is_new = not os.path.exists(filename)
+        self.conn = _connect(filename)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS traces ("
+            "tx_hash TEXT PRIMARY KEY, mask BLOB NOT NULL, extra TEXT"
+            ") WITHOUT ROWID"
+        )
+        self.conn.commit()
+        if is_new and legacy_filename and os.path.exists(legacy_filename):
+            self._import_legacy(legacy_filename)
+
+    def _import_legacy(self, legacy_filename):
+        cfg.linfo(f"Importing trace cache from {legacy_filename}")
+        with open(legacy_filename, 'r') as f:
+            legacy = json.load(f)
+        self.put_many(legacy.items())
+        self.commit()
+        cfg.linfo(f"Imported {len(legacy)} traces to the trace cache")
+
+    def __contains__(self, tx_hash):
+        return self.conn.execute(
+            "SELECT 1 FROM traces WHERE tx_hash = ?", (tx_hash,)
+        ).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM traces").fetchone()[0]
+
+    def get(self, tx_hash):
+        row = self.conn.execute(
+            "SELECT mask, extra FROM traces WHERE tx_hash = ?", (tx_hash,)
+        ).fetchone()
+        if row is None:
+            return None
+        mask, extra = row
+        return mask_to_opcodes(
+            int.from_bytes(mask, 'big'), json.loads(extra) if extra else [])
+
+    def missing(self, tx_hashes):
+        found = set()
+        for chunk_tx_hashes in chunks(
+            list(tx_hashes), SQL_VARIABLES_PER_QUERY
+        ):
+            found.update(row[0] for row in self.conn.execute(
+                "SELECT tx_hash FROM traces WHERE tx_hash IN "
+                f"({','.join('?' * len(chunk_tx_hashes))})",
+                chunk_tx_hashes
+            ))
+        return [x for x in tx_hashes if x not in found]
+
+    def put_many(self, items):
+        rows = []
+        for tx_hash, opcodes in items:
+            mask, extra = opcodes_to_mask(opcodes)
+            rows.append((
+                tx_hash, mask.to_bytes(32, 'big'),
+                json.dumps(extra) if extra else None
+            ))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO traces (tx_hash, mask, extra) "
+            "VALUES (?, ?, ?)", rows
+        )
+
+    def put(self, tx_hash, opcodes):
+        self.put_many([(tx_hash, opcodes)])
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class RPCCache:
+    # RPC answers by request, content addressed (hash of the endpoint role,
+    #  method, params and stream parser), as zlib compressed json. Past
+    #  max_bytes the least recently used ones are evicted. Shared by the
+    #  fetcher threads
+    def __init__(self, filename, max_bytes):
+        self.conn = _connect(filename, check_same_thread=False)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " key BLOB PRIMARY KEY, answer BLOB NOT NULL,"
+            " size INTEGER NOT NULL, used REAL NOT NULL) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS answers_used ON answers (used);"
+        )
+        self.conn.commit()
+        self.lock = Lock()
+        self.max_bytes = max_bytes
+        self.size = self._size()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    def _size(self):
+        return self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+
+    @staticmethod
+    def key(*request):
+        return sha256(
+            json.dumps(request, sort_keys=True, separators=(',', ':'))
+            .encode()
+        ).digest()
+
+    def get_many(self, keys):
+        # {key: answer} of the keys found, which are marked as used now
+        keys = list(keys)
+        found = {}
+        with self.lock:
+            for _keys in chunks(keys, SQL_VARIABLES_PER_QUERY):
+                for key, answer in self.conn.execute(
+                    "SELECT key, answer FROM answers WHERE key IN "
+                    f"({','.join('?' * len(_keys))})", _keys
+                ):
+                    found[key] = json.loads(zlib.decompress(answer))
+            if found:
+                now = time()
+                self.conn.executemany(
+                    "UPDATE answers SET used = ? WHERE key = ?",
+                    ((now, key) for key in found))
+                self.conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        # items: (key, answer)
+        now = time()
+        rows = []
+        for key, answer in items:
+            blob = zlib.compress(
+                json.dumps(answer, separators=(',', ':')).encode())
+            rows.append((key, blob, len(blob), now))
+        if not rows:
+            return
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO answers (key, answer, size, used) "
+                "VALUES (?, ?, ?, ?)", rows)
+            self.stored += len(rows)
+            self.size += sum(row[2] for row in rows)
+            if self.size > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # Down to 90% of the limit, so it does not run on every put
+        self.size = self._size()
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, size in self.conn.execute(
+            "SELECT key, size FROM answers ORDER BY used"
+        ):
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.conn.executemany("DELETE FROM answers WHERE key = ?", evicted)
+        self.evicted += len(evicted)
+
+    def __str__(self):
+        return \
+            f"hits={self.hits} misses={self.misses} stored={self.stored} " \
+            f"evicted={self.evicted} size={self.size / 2**20:.1f}MB"
+
+    def close(self):
+        self.conn.close()
+
+
+class DownloadCheckpoint:
+    # Txs of the batches downloaded for the shard in progress, added as each
+    #  request completes, so a killed download resumes with the missing
+    #  batches only. Empty batches are kept too, as done (with null txs if
+    #  answered with an error). Shards written keep their coverage: the tx
+    #  count of each batch (MISSING_BATCH if not fetched, EMPTY_BY_ERROR),
+    #  4 bytes per batch in a row per shard
+    def __init__(self, filename):
+        self.conn = _connect(filename)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            " batch_number INTEGER PRIMARY KEY, txs TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS coverage ("
+            " first_batch INTEGER PRIMARY KEY, last_batch INTEGER NOT NULL,"
+            " tx_counts BLOB NOT NULL);"
+        )
+        self.conn.commit()
+
+    def done(self, first_batch, last_batch):
+        return set(
+            row[0] for row in self.conn.execute(
+                "SELECT batch_number FROM batches "
+                "WHERE batch_number BETWEEN ? AND ?",
+                (first_batch, last_batch))
+        )
+
+    def add(self, batches):
+        # batches: (batch number, txs), txs None if empty by error
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO batches (batch_number, txs) VALUES (?, ?)",
+            (
+                (batch_number, json.dumps(txs, separators=(',', ':')))
+                for batch_number, txs in batches
+            )
+        )
+        self.conn.commit()
+
+    def iter_txs(self, first_batch, last_batch):
+        for (txs,) in self.conn.execute(
+            "SELECT txs FROM batches WHERE batch_number BETWEEN ? AND ? "
+            "ORDER BY batch_number", (first_batch, last_batch)
+        ):
+            yield from json.loads(txs) or []
+
+    def clear(self, first_batch, last_batch):
+        self.conn.execute(
+            "DELETE FROM batches WHERE batch_number BETWEEN ? AND ?",
+            (first_batch, last_batch))
+        self.conn.commit()
+
+    def tx_counts(self, first_batch, last_batch):
+        # Coverage of the batches here, as shard_written keeps it
+        tx_counts = array('I', [MISSING_BATCH]) * \
+            (last_batch - first_batch + 1)
+        for batch_number, tx_count in self.conn.execute(
+            "SELECT batch_number, CASE txs WHEN 'null' THEN ? "
+            "ELSE json_array_length(txs) END FROM batches "
+            "WHERE batch_number BETWEEN ? AND ?",
+            (EMPTY_BY_ERROR, first_batch, last_batch)
+        ):
+            tx_counts[batch_number - first_batch] = tx_count
+        return tx_counts
+
+    def shard_written(self, first_batch, last_batch, clear):
+        # Coverage of a shard just written from the batches here, which are
+        #  cleared (if asked) with the same commit. Replaces the coverage of
+        #  the former shard of these batches
+        tx_counts = self.tx_counts(first_batch, last_batch)
+        self.conn.execute(
+            "DELETE FROM coverage WHERE first_batch BETWEEN ? AND ?",
+            (first_batch, last_batch))
+        self.conn.execute(
+            "INSERT INTO coverage (first_batch, last_batch, tx_counts) "
+            "VALUES (?, ?, ?)", (first_batch, last_batch, tx_counts.tobytes()))
+        if clear:
+            self.conn.execute(
+                "DELETE FROM batches WHERE batch_number BETWEEN ? AND ?",
+                (first_batch, last_batch))
+        self.conn.commit()
+
+    def covered(self, first_batch):
+        # Last batch of the shard covered from first_batch, None if none
+        row = self.conn.execute(
+            "SELECT last_batch FROM coverage WHERE first_batch = ?",
+            (first_batch,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def coverage(self):
+        # (first batch, last batch, tx counts) of each shard, by batch
+        for first_batch, last_batch, blob in self.conn.execute(
+            "SELECT first_batch, last_batch, tx_counts FROM coverage "
+            "ORDER BY first_batch"
+        ).fetchall():
+            tx_counts = array('I')
+            tx_counts.frombytes(blob)
+            yield first_batch, last_batch, tx_counts
+
+    def close(self):
+        self.conn.close()
+
+
+class ContractStore:
+    # Contracts, their txs and the no-contract addresses, written per
+    #  transactions file: changes are buffered and committed together with
+    #  the file name on checkpoint(), so a killed run resumes from there.
+    #  Runtimes (and their opcodes, with the reachability of each) are kept
+    #  once per code hash, contracts point to it. The opcodes of a runtime
+    #  are also kept as 256-bit masks: present / may be reachable. The
+    #  conflicts found by the analyzer are kept up to a tx seq watermark,
+    #  flagged once traced, and the contracts as the analyzer last saw them
+    def __init__(self, filename):
+        self.conn = _connect(filename)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS contracts ("
+            " address TEXT PRIMARY KEY, create_tx_hash TEXT,"
+            " create_block TEXT, creator TEXT, input TEXT, code_hash TEXT,"
+            " tx_count INTEGER NOT NULL DEFAULT 0, file TEXT);"
+            "CREATE TABLE IF NOT EXISTS runtimes ("
+            " code_hash TEXT PRIMARY KEY, runtime TEXT NOT NULL,"
+            " opcodes TEXT, reachability TEXT, mask BLOB,"
+            " reachable_mask BLOB);"
+            "CREATE TABLE IF NOT EXISTS contract_txs ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT, address TEXT NOT NULL,"
+            " tx_hash TEXT NOT NULL, success INTEGER NOT NULL, file TEXT);"
+            "CREATE INDEX IF NOT EXISTS contract_txs_address"
+            " ON contract_txs (address, seq);"
+            "CREATE TABLE IF NOT EXISTS no_contracts ("
+            " address TEXT PRIMARY KEY, file TEXT) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS processed_files ("
+            " name TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT"
+            ") WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS conflicts ("
+            " opcode TEXT NOT NULL, seq INTEGER NOT NULL, address TEXT,"
+            " tx_hash TEXT, PRIMARY KEY (opcode, seq)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS conflicts_seq ON conflicts (seq);"
+            "CREATE TABLE IF NOT EXISTS analyzer_state ("
+            " name TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS analyzed_contracts ("
+            " address TEXT PRIMARY KEY, tx_count INTEGER, code_hash TEXT"
+            ") WITHOUT ROWID;"
+        )
+        # Conflicts kept before the traced flag are checked again
+        columns = [
+            row[1] for row in
+            self.conn.execute("PRAGMA table_info(conflicts)")
+        ]
+        if 'traced' not in columns:
+            self.conn.execute(
+                "ALTER TABLE conflicts ADD COLUMN "
+                "traced INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS conflicts_untraced ON conflicts (seq) "
+            "WHERE traced = 0")
+        # Stores created before the manifest had only the file name
+        columns = [
+            row[1] for row in
+            self.conn.execute("PRAGMA table_info(processed_files)")
+        ]
+        for column, kind in (
+            ('size', 'INTEGER'), ('mtime', 'REAL'), ('hash', 'TEXT')
+        ):
+            if column not in columns:
+                self.conn.execute(
+                    f"ALTER TABLE processed_files ADD COLUMN {column} {kind}")
+        # Runtimes analyzed before the reachability are analyzed again,
+        #  the masks of the ones analyzed before them are set from the json
+        columns = [
+            row[1] for row in self.conn.execute("PRAGMA table_info(runtimes)")
+        ]
+        for column, kind in (
+            ('reachability', 'TEXT'), ('mask', 'BLOB'),
+            ('reachable_mask', 'BLOB')
+        ):
+            if column not in columns:
+                self.conn.execute(
+                    f"ALTER TABLE runtimes ADD COLUMN {column} {kind}")
+        if 'mask' not in columns:
+            self.set_opcodes(
+                (_code_hash, json.loads(opcodes), json.loads(reachability))
+                for _code_hash, opcodes, reachability in self.conn.execute(
+                    "SELECT code_hash, opcodes, reachability FROM runtimes "
+                    "WHERE opcodes IS NOT NULL AND reachability IS NOT NULL"
+                ).fetchall()
+            )
+        self.conn.commit()
+        self._migrate_runtimes()
+        self._contracts = None
+        self._no_contracts = None
+        self._created = {}
+        self._pending_txs = {}
+        self._pending_no_contracts = []
+
+    def _migrate_runtimes(self):
+        # Stores created before had the runtime and opcodes per contract
+        columns = [
+            row[1] for row in
+            self.conn.execute("PRAGMA table_info(contracts)")
+        ]
+        if 'runtime' not in columns:
+            return
+        cfg.linfo("Moving contract runtimes to the runtimes table")
+        self.conn.execute("ALTER TABLE contracts ADD COLUMN code_hash TEXT")
+        hashes = []
+        for address, runtime, opcodes in self.conn.execute(
+            "SELECT address, runtime, opcodes FROM contracts "
+            "WHERE runtime IS NOT NULL AND runtime != ''"
+        ).fetchall():
+            hashes.append((self._put_runtime(runtime, opcodes), address))
+        self.conn.executemany(
+            "UPDATE contracts SET code_hash = ? WHERE address = ?", hashes)
+        self.conn.execute("ALTER TABLE contracts DROP COLUMN runtime")
+        self.conn.execute("ALTER TABLE contracts DROP COLUMN opcodes")
+        self.conn.commit()
+        cfg.linfo(
+            f"Moved {len(hashes)} runtimes, {self.count_runtimes()} unique")
+
+    def _put_runtime(self, runtime, opcodes=None):
+        if not runtime:
+            return None
+        _code_hash = code_hash(runtime)
+        self.conn.execute(
+            "INSERT INTO runtimes (code_hash, runtime, opcodes) "
+            "VALUES (?, ?, ?) ON CONFLICT (code_hash) DO UPDATE SET "
+            "opcodes = COALESCE(opcodes, excluded.opcodes)",
+            (_code_hash, runtime, opcodes))
+        return _code_hash
+
+    # Addresses are kept in memory for the lookups of the processor, the
+    #  rest of the contract info stays on disk
+    @property
+    def contracts(self):
+        if self._contracts is None:
+            self._contracts = set(
+                row[0] for row in
+                self.conn.execute("SELECT address FROM contracts"))
+        return self._contracts
+
+    @property
+    def no_contracts(self):
+        if self._no_contracts is None:
+            self._no_contracts = set(
+                row[0] for row in
+                self.conn.execute("SELECT address FROM no_contracts"))
+        return self._no_contracts
+
+    def create_contract(self, address, **fields):
+        # A contract created again starts from scratch, as its txs
+        self.contracts.add(address)
+        self._created[address] = fields
+        self._pending_txs.pop(address, None)
+
+    def add_tx(self, address, tx_hash, success):
+        self._pending_txs.setdefault(address, []).append(
+            (tx_hash, 1 if success else 0))
+
+    def add_no_contract(self, address):
+        if address not in self.no_contracts:
+            self.no_contracts.add(address)
+            self._pending_no_contracts.append(address)
+
+    def checkpoint(self, name, size=None, mtime=None, hash=None):
+        for address, fields in self._created.items():
+            self.conn.execute(
+                "DELETE FROM conflicts WHERE address = ?", (address,))
+            self.conn.execute(
+                "DELETE FROM contract_txs WHERE address = ?", (address,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO contracts (address, create_tx_hash, "
+                "create_block, creator, input, code_hash, file) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    address, fields.get('create_tx_hash'),
+                    fields.get('create_block'), fields.get('creator'),
+                    fields.get('input'),
+                    self._put_runtime(fields.get('runtime')), name
+                )
+            )
+        self.conn.executemany(
+            "INSERT INTO contract_txs (address, tx_hash, success, file) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                (address, tx_hash, success, name)
+                for address, txs in self._pending_txs.items()
+                for tx_hash, success in txs
+            )
+        )
+        self.conn.executemany(
+            "UPDATE contracts SET tx_count = tx_count + ? WHERE address = ?",
+            (
+                (len(txs), address)
+                for address, txs in self._pending_txs.items()
+            )
+        )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO no_contracts (address, file) VALUES (?, ?)",
+            ((address, name) for address in self._pending_no_contracts)
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO processed_files (name, size, mtime, hash) "
+            "VALUES (?, ?, ?, ?)", (name, size, mtime, hash))
+        self.conn.commit()
+        self._created = {}
+        self._pending_txs = {}
+        self._pending_no_contracts = []
+
+    def is_processed(self, name):
+        return self.conn.execute(
+            "SELECT 1 FROM processed_files WHERE name = ?", (name,)
+        ).fetchone() is not None
+
+    def processed_files(self):
+        # Manifest of files folded in: (name, size, mtime, hash)
+        return self.conn.execute(
+            "SELECT name, size, mtime, hash FROM processed_files "
+            "ORDER BY name"
+        ).fetchall()
+
+    def touch_file(self, name, mtime):
+        self.conn.execute(
+            "UPDATE processed_files SET mtime = ? WHERE name = ?",
+            (mtime, name))
+        self.conn.commit()
+
+    def rename_file(self, name, new_name, size, mtime, hash):
+        # Same content under another file (converted to another format)
+        for table in ('contracts', 'contract_txs', 'no_contracts'):
+            self.conn.execute(
+                f"UPDATE {table} SET file = ? WHERE file = ?",
+                (new_name, name))
+        self.conn.execute(
+            "UPDATE processed_files SET name = ?, size = ?, mtime = ?, "
+            "hash = ? WHERE name = ?", (new_name, size, mtime, hash, name))
+        self.conn.commit()
+
+    def rollback_file(self, name):
+        # Undo everything a file added. Contracts created in it go away with
+        #  all their txs, the other contracts lose only the file txs
+        addresses = [
+            row[0] for row in self.conn.execute(
+                "SELECT DISTINCT address FROM contract_txs WHERE file = ?",
+                (name,))
+        ]
+        # Conflicts of these txs go with them, tx seqs are never reused so
+        #  the analyzer watermark stays valid
+        self.conn.execute(
+            "DELETE FROM conflicts WHERE seq IN (SELECT seq FROM contract_txs "
+            "WHERE file = ? OR address IN "
+            "(SELECT address FROM contracts WHERE file = ?))", (name, name))
+        self.conn.execute(
+            "DELETE FROM contract_txs WHERE file = ? OR address IN "
+            "(SELECT address FROM contracts WHERE file = ?)", (name, name))
+        self.conn.execute("DELETE FROM contracts WHERE file = ?", (name,))
+        self.conn.execute("DELETE FROM no_contracts WHERE file = ?", (name,))
+        self.conn.executemany(
+            "UPDATE contracts SET tx_count = (SELECT COUNT(*) FROM "
+            "contract_txs t WHERE t.address = contracts.address) "
+            "WHERE address = ?", ((address,) for address in addresses))
+        self.conn.execute(
+            "DELETE FROM processed_files WHERE name = ?", (name,))
+        self.conn.commit()
+        self._contracts = None
+        self._no_contracts = None
+
+    def count_contracts(self):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM contracts").fetchone()[0]
+
+    def count_runtimes(self):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM runtimes").fetchone()[0]
+
+    def count_no_contracts(self):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM no_contracts").fetchone()[0]
+
+    def count_txs(self, success):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM contract_txs WHERE success = ?",
+            (1 if success else 0,)
+        ).fetchone()[0]
+
+    def iter_contracts(self):
+        # (address, tx_count, code_hash), without loading them all
+        return self.conn.execute(
+            "SELECT address, tx_count, code_hash FROM contracts "
+            "ORDER BY rowid")
+
+    def iter_runtimes(self):
+        # (code_hash, opcodes, reachability) of the runtimes already analyzed
+        for _code_hash, opcodes, reachability in self.conn.execute(
+            "SELECT code_hash, opcodes, reachability FROM runtimes "
+            "WHERE opcodes IS NOT NULL AND reachability IS NOT NULL"
+        ):
+            yield _code_hash, json.loads(opcodes), json.loads(reachability)
+
+    def iter_masks(self):
+        # (code_hash, mask, reachable_mask) of the runtimes analyzed
+        for _code_hash, mask, reachable_mask in self.conn.execute(
+            "SELECT code_hash, mask, reachable_mask FROM runtimes "
+            "WHERE mask IS NOT NULL"
+        ):
+            yield _code_hash, int.from_bytes(mask, 'big'), \
+                int.from_bytes(reachable_mask, 'big')
+
+    def missing_opcodes(self):
+        # (code_hash, runtime) of the runtimes not analyzed yet
+        return self.conn.execute(
+            "SELECT code_hash, runtime FROM runtimes "
+            "WHERE opcodes IS NULL OR reachability IS NULL"
+        ).fetchall()
+
+    def contract_txs(self, address, success):
+        return [
+            row[0] for row in self.conn.execute(
+                "SELECT tx_hash FROM contract_txs "
+                "WHERE address = ? AND success = ? ORDER BY seq",
+                (address, 1 if success else 0)
+            )
+        ]
+
+    def get(self, address):
+        row = self.conn.execute(
+            "SELECT create_tx_hash, create_block, creator, input, code_hash, "
+            "tx_count FROM contracts WHERE address = ?", (address,)
+        ).fetchone()
+        if row is None:
+            return None
+        keys = (
+            'create_tx_hash', 'create_block', 'creator', 'input', 'code_hash',
+            'tx_count'
+        )
+        contract = {k: v for k, v in zip(keys, row) if v is not None}
+        contract['txs'] = self.contract_txs(address, True)
+        contract['failed_txs'] = self.contract_txs(address, False)
+        return contract
+
+    def analyzed_seq(self, signature):
+        # Last tx seq whose conflicts are kept, None if the conflicts were
+        #  found with other settings (signature) or never
+        state = dict(self.conn.execute(
+            "SELECT name, value FROM analyzer_state"))
+        if state.get('signature') != signature or 'seq' not in state:
+            return None
+        return int(state['seq'])
+
+    def reset_conflicts(self):
+        self.conn.execute("DELETE FROM conflicts")
+        self.conn.execute("DELETE FROM analyzer_state")
+        self.conn.execute("DELETE FROM analyzed_contracts")
+        self.conn.commit()
+
+    def analyzed_pruned(self):
+        # Contracts left out of conflicts by opcode, as of the contracts the
+        #  analyzer last saw, None if it never saved them
+        row = self.conn.execute(
+            "SELECT value FROM analyzer_state WHERE name = 'pruned'"
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def drop_analyzed_contracts(self):
+        # Before the analyzer writes its files: if killed while at it, the
+        #  next run rebuilds them from all contracts
+        self.conn.execute("DELETE FROM analyzer_state WHERE name = 'pruned'")
+        self.conn.commit()
+
+    def changed_contracts(self):
+        # (address, tx_count, code_hash, analyzed tx_count, analyzed
+        #  code_hash) of the contracts changed since the analyzer saw them:
+        #  new ones (analyzed None) in contract order, then the ones gone
+        #  (rolled back, tx_count and code_hash None)
+        return self.conn.execute(
+            "SELECT c.address, c.tx_count, c.code_hash, a.tx_count, "
+            "a.code_hash FROM contracts c "
+            "LEFT JOIN analyzed_contracts a ON a.address = c.address "
+            "WHERE a.address IS NULL OR a.tx_count != c.tx_count "
+            "OR a.code_hash IS NOT c.code_hash ORDER BY c.rowid"
+        ).fetchall() + self.conn.execute(
+            "SELECT a.address, NULL, NULL, a.tx_count, a.code_hash "
+            "FROM analyzed_contracts a "
+            "LEFT JOIN contracts c ON c.address = a.address "
+            "WHERE c.address IS NULL"
+        ).fetchall()
+
+    def set_analyzed_contracts(self, contracts, pruned, full=False):
+        # (address, tx_count, code_hash) as the analyzer saw them, tx_count
+        #  None for the ones gone. full: all of them, the rest are dropped
+        if full:
+            self.conn.execute("DELETE FROM analyzed_contracts")
+        contracts = list(contracts)
+        self.conn.executemany(
+            "DELETE FROM analyzed_contracts WHERE address = ?",
+            ((address,) for address, tx_count, _ in contracts
+             if tx_count is None))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO analyzed_contracts "
+            "(address, tx_count, code_hash) VALUES (?, ?, ?)",
+            (contract for contract in contracts if contract[1] is not None))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO analyzer_state (name, value) "
+            "VALUES ('pruned', ?)", (json.dumps(pruned),))
+        self.conn.commit()
+
+    def get_runtime(self, _code_hash):
+        # (opcodes, reachability) of an analyzed runtime
+        opcodes, reachability = self.conn.execute(
+            "SELECT opcodes, reachability FROM runtimes WHERE code_hash = ?",
+            (_code_hash,)
+        ).fetchone()
+        return json.loads(opcodes), json.loads(reachability)
+
+    def iter_txs(self, after_seq=0):
+        # (seq, address, tx_hash, success, code_hash) of the txs after seq
+        return self.conn.execute(
+            "SELECT t.seq, t.address, t.tx_hash, t.success, c.code_hash "
+            "FROM contract_txs t JOIN contracts c ON c.address = t.address "
+            "WHERE t.seq > ? ORDER BY t.seq", (after_seq,))
+
+    def add_conflicts(self, conflicts, seq, signature):
+        # (opcode, address, tx_hash, seq) found up to seq, saved together
+        #  with the new watermark
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO conflicts (opcode, address, tx_hash, seq) "
+            "VALUES (?, ?, ?, ?)", conflicts)
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO analyzer_state (name, value) "
+            "VALUES (?, ?)", (('seq', str(seq)), ('signature', signature)))
+        self.conn.commit()
+
+    def conflicts(self, opcode, untraced=False):
+        # {address: [tx_hash, ...]} for the opcode, in contract and tx order.
+        #  untraced: only the txs not traced yet
+        result = {}
+        for address, tx_hash in self.conn.execute(
+            "SELECT k.address, k.tx_hash FROM conflicts k "
+            "JOIN contracts c ON c.address = k.address "
+            "WHERE k.opcode = ? AND k.traced <= ? ORDER BY c.rowid, k.seq",
+            (opcode, 0 if untraced else 1)
+        ):
+            result.setdefault(address, []).append(tx_hash)
+        return result
+
+    def untraced_conflicts(self):
+        # (seq, tx_hash) of the conflicting txs not traced yet
+        return self.conn.execute(
+            "SELECT DISTINCT seq, tx_hash FROM conflicts WHERE traced = 0"
+        ).fetchall()
+
+    def set_traced(self, seqs):
+        self.conn.executemany(
+            "UPDATE conflicts SET traced = 1 WHERE seq = ?",
+            ((seq,) for seq in seqs))
+        self.conn.commit()
+
+    def reset_traced(self):
+        # The traces are gone, every conflicting tx is to trace again
+        self.conn.execute("UPDATE conflicts SET traced = 0 WHERE traced = 1")
+        self.conn.commit()
+
+    def missing_runtimes(self):
+        return [
+            row[0] for row in self.conn.execute(
+                "SELECT address FROM contracts "
+                "WHERE code_hash IS NULL ORDER BY rowid")
+        ]
+
+    def set_runtimes(self, runtimes):
+        for address, runtime in runtimes:
+            self.conn.execute(
+                "UPDATE contracts SET code_hash = ? WHERE address = ?",
+                (self._put_runtime(runtime), address))
+        self.conn.commit()
+
+    def set_opcodes(self, opcodes):
+        # (code_hash, opcodes, reachability) for each runtime analyzed
+        self.conn.executemany(
+            "UPDATE runtimes SET opcodes = ?, reachability = ?, mask = ?, "
+            "reachable_mask = ? WHERE code_hash = ?",
+            (
+                (
+                    json.dumps(ops), json.dumps(reachability),
+                    hex_to_mask(ops).to_bytes(32, 'big'),
+                    hex_to_mask(
+                        opcode for opcode, reach in reachability.items()
+                        if reach != UNREACHABLE
+                    ).to_bytes(32, 'big'),
+                    _code_hash
+                )
+                for _code_hash, ops, reachability in opcodes
+            )
+        )
+        self.conn.commit()
+
+    def export_json(
+        self, output_folder, contracts_file, runtimes_file, no_contracts_file
+    ):
+        # Contracts point to their runtime in the runtimes file by code hash,
+        #  all files are written item by item
+        Path(output_folder).mkdir(parents=True, exist_ok=True)
+        filename = os.path.join(output_folder, contracts_file)
+        cfg.linfo(f"Exporting contracts to {filename}")
+        with open(filename, 'w') as f:
+            f.write('{')
+            addresses = self.conn.execute(
+                "SELECT address FROM contracts ORDER BY rowid").fetchall()
+            for i, (address,) in enumerate(addresses):
+                f.write(',\n' if i else '\n')
+                f.write(
+                    f"{json.dumps(address)}: "
+                    f"{json.dumps(self.get(address))}")
+            f.write('\n}\n')
+
+        filename = os.path.join(output_folder, runtimes_file)
+        cfg.linfo(f"Exporting runtimes to {filename}")
+        with open(filename, 'w') as f:
+            f.write('{')
+            for i, (_code_hash, runtime, opcodes, reachability) in enumerate(
+                self.conn.execute(
+                    "SELECT code_hash, runtime, opcodes, reachability "
+                    "FROM runtimes "
+                    "WHERE code_hash IN (SELECT code_hash FROM contracts) "
+                    "ORDER BY rowid")
+            ):
+                f.write(',\n' if i else '\n')
+                f.write(f"{json.dumps(_code_hash)}: {{\"runtime\": ")
+                f.write(json.dumps(runtime))
+                if opcodes is not None:
+                    f.write(f", \"opcodes\": {opcodes}")
+                if reachability is not None:
+                    f.write(f", \"reachability\": {reachability}")
+                f.write('}')
+            f.write('\n}\n')
+
+        filename = os.path.join(output_folder, no_contracts_file)
+        cfg.linfo(f"Exporting no contracts to {filename}")
+        with open(filename, 'w') as f:
+            f.write('{')
+            for i, (address,) in enumerate(self.conn.execute(
+                "SELECT address FROM no_contracts"
+            )):
+                f.write(',\n' if i else '\n')
+                f.write(f"{json.dumps(address)}: true")
+            f.write('\n}\n')
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,90 @@
+import random
+import pytest
+from evm_opcodes import count_opcodes, OPCODE_HEX
+
+# count_opcodes checked against the hex-string scanner 2_analyzer used
+#  before it: python -m pytest -q
+
+
+def reference_scan(runtime):
+    # The old check_runtime loop, kept as it was
+    runtime = runtime[2:]
+    bytes_left = len(runtime) // 2
+    pc = 0
+    opcodes = {}
+
+    while bytes_left > 0:
+        opcode = runtime[pc*2:pc*2+2]
+        opcodes[opcode] = opcodes.get(opcode, 0) + 1
+        pc += 1
+        bytes_left -= 1
+
+        is_push = int(opcode, 16) >= 0x60 and int(opcode, 16) <= 0x7f
+        if is_push:
+            push_bytes = int(opcode, 16) - 0x5f
+            if push_bytes > bytes_left:
+                break
+            pc += push_bytes
+            bytes_left -= push_bytes
+
+    return opcodes
+
+
+def scan(runtime):
+    # As 2_analyzer calls count_opcodes now
+    counts = count_opcodes(bytes.fromhex(runtime[2:]))
+    return {
+        OPCODE_HEX[opcode]: count
+        for opcode, count in enumerate(counts) if count
+    }
+
+
+def random_code(rnd, size):
+    # Biased towards pushes, so immediates and truncations are common
+    pushes = list(range(0x5f, 0x80))
+    return bytes(
+        rnd.choice(pushes) if rnd.random() < 0.3 else rnd.randrange(256)
+        for _ in range(size)
+    )
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_codes(seed):
+    rnd = random.Random(seed)
+    for _ in range(100):
+        runtime = '0x' + random_code(rnd, rnd.randrange(200)).hex()
+        assert scan(runtime) == reference_scan(runtime)
+
+
+@pytest.mark.parametrize('runtime', [
+    '0x',
+    '0x00',
+    '0x60',
+    '0x6001',
+    '0x600160',
+    '0x61ff',
+    '0x7f' + '00' * 31,
+    '0x7f' + '00' * 32,
+    '0x' + '01' * 3 + '7f',
+    '0x5b' + '7f' + 'ff' * 32 + '00',
+    '0x5f5f5f',
+    '0x' + 'ff' * 64,
+])
+def test_edge_codes(runtime):
+    # Empty code, truncated pushes at the end and PUSH32 at the tail
+    assert scan(runtime) == reference_scan(runtime)
+
+
+def test_push32_at_tail():
+    runtime = '0x6001' + '7f' + '11' * 32
+    assert scan(runtime) == {'60': 1, '7f': 1}
+    assert scan(runtime[:-2]) == {'60': 1, '7f': 1}
+
+
+@pytest.mark.parametrize('runtime', ['0x6', '0x600', '0x7f00000'])
+def test_odd_length(runtime):
+    # The old scanner drops the last nibble, the runtime can not be decoded
+    #  now (2_analyzer asserts an even length before)
+    with pytest.raises(ValueError):
+        scan(runtime)
+    assert reference_scan(runtime) == scan(runtime[:-1])
@@ -0,0 +1,155 @@
+import json
+import os
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+# The async fetcher and the endpoints pool against local JSON-RPC nodes, a
+#  healthy one and a flaky one (HTTP errors and items answered with an
+#  error): python -m pytest -q
+os.environ.setdefault('ENV', 'cardona')
+import config as cfg  # noqa: E402
+import downloader_helper  # noqa: E402
+from rpc_controller import get_controller  # noqa: E402
+
+N_BATCHES = 300
+
+
+def batch(n):
+    # Every 7th batch is empty, answered as the node does
+    if n % 7 == 3:
+        return None
+    return {
+        'number': hex(n),
+        'transactions': [
+            {'hash': '0x%064x' % (n * 10 + i), 'receipt': {}}
+            for i in range(n % 3 + 1)
+        ],
+    }
+
+
+def answer(request):
+    n = int(request['params'][0], 16)
+    if (b := batch(n)) is None:
+        return {'jsonrpc': '2.0', 'id': request['id'], 'error': {
+            'code': -32000, 'message': 'method handler crashed'}}
+    return {'jsonrpc': '2.0', 'id': request['id'], 'result': b}
+
+
+def start_node(http_fail=0.0, item_fail=0.0):
+    rnd = random.Random(0)
+    lock = threading.Lock()
+    counts = {'requests': 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(
+                self.headers['Content-Length'])))
+            with lock:
+                counts['requests'] += 1
+                code = 503 if rnd.random() < http_fail else 200
+                fails = [rnd.random() < item_fail for _ in body]
+            out = [
+                {'jsonrpc': '2.0', 'id': request['id'], 'error': {
+                    'code': -32000, 'message': 'random failure'}}
+                if fail else answer(request)
+                for request, fail in zip(body, fails)
+            ]
+            data = json.dumps(out if code == 200 else 'busy').encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}', counts
+
+
+@pytest.fixture
+def nodes(monkeypatch):
+    # Retries do not wait, the failover to the other node is what matters
+    monkeypatch.setattr(downloader_helper.time, 'sleep', lambda _: None)
+    monkeypatch.setattr(cfg, 'RPC_CACHE', 'off')
+    started = []
+
+    def _nodes(*nodes):
+        for kwargs in nodes:
+            started.append(start_node(**kwargs))
+        monkeypatch.setattr(
+            cfg, 'EP_LIST', ','.join(url for _, url, _ in started))
+        return started
+
+    yield _nodes
+    for server, _, _ in started:
+        server.shutdown()
+        server.server_close()
+
+
+def test_batch_fetcher_coverage(nodes):
+    nodes({}, {'http_fail': 0.3, 'item_fail': 0.2})
+    batches = []
+    errors = []
+    downloader_helper.batch_fetcher(
+        range(N_BATCHES), errors=errors, on_batches=batches.extend)
+
+    assert errors == []
+    assert sorted(n for n, _ in batches) == list(range(N_BATCHES))
+    for n, txs in batches:
+        expected = batch(n)
+        assert txs == (
+            expected and [
+                downloader_helper.slim_tx(tx)
+                for tx in expected['transactions']
+            ])
+
+
+def test_rpc_fetcher_order(nodes):
+    nodes({}, {'http_fail': 0.3, 'item_fail': 0.2})
+    requests = [
+        {
+            'method': 'zkevm_getBatchByNumber',
+            'params': [hex(n), True],
+            'id': n
+        }
+        for n in range(N_BATCHES)
+    ]
+    errors = []
+    chunks = downloader_helper.rpc_fetcher(
+        cfg.EP_LIST, requests, cfg.DOWNLOAD_QUERIES_PER_REQUEST,
+        errors=errors)
+
+    assert errors == []
+    # Chunks in the order of the requests, and each one in its order
+    assert [
+        request['id'] for chunk_requests, _ in chunks
+        for request in chunk_requests
+    ] == list(range(N_BATCHES))
+    assert [
+        result['number'] for _, results in chunks for result in results
+    ] == [n for n in range(N_BATCHES) if batch(n)]
+
+
+def test_node_failing_every_item(nodes):
+    # Answers 200 with an error on every item: it is taken down and the
+    #  healthy node gets the rest of the requests
+    (_, _, healthy), (_, failing_url, failing) = \
+        nodes({}, {'item_fail': 1.0})
+    batches = []
+    errors = []
+    downloader_helper.batch_fetcher(
+        range(N_BATCHES), errors=errors, on_batches=batches.extend)
+
+    assert errors == []
+    assert sorted(n for n, _ in batches) == list(range(N_BATCHES))
+    controller = get_controller(failing_url)
+    assert controller.health() == 0
+    assert controller.item_errors > 0
+    assert failing['requests'] < healthy['requests']
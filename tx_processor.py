@@ -0,0 +1,209 @@
+import os
+import config as cfg
+from time import time
+from utils import file_hash
+from downloader_helper import contract_fetcher, resolve_contract_codes
+from shards import (
+    contained_shards, list_shards, iter_shard, shard_batches)
+
+
+class TxProcessor:
+    # Contracts classification of 1_processor: the txs of each transactions
+    #  file are folded in the store (contracts, their txs and no-contract
+    #  addresses) and checkpointed with the file. Txs are read from the
+    #  files, or taken as they come from 0_downloader in streaming mode
+    def __init__(self, store, transactions_folder):
+        self.store = store
+        self.transactions_folder = transactions_folder
+
+    def file_changed(self, name, size, mtime, hash):
+        full_path = os.path.join(self.transactions_folder, name)
+        if not os.path.exists(full_path):
+            return True
+        stat = os.stat(full_path)
+        if size is None:
+            # Checkpointed before the manifest, trust it as it is now
+            self.store.checkpoint(
+                name, stat.st_size, stat.st_mtime, file_hash(full_path))
+            return False
+        if stat.st_size != size:
+            return True
+        if stat.st_mtime == mtime:
+            return False
+        if file_hash(full_path) != hash:
+            return True
+        self.store.touch_file(name, stat.st_mtime)
+        return False
+
+    def processed_names(self):
+        return set(_file for _file, *_ in self.store.processed_files())
+
+    def rollback_changed(self):
+        # Files removed or regenerated since folded in (usually the last
+        #  one, that 0_downloader fetches again) are rolled back, together
+        #  with all files after them, and processed again. So are the ones
+        #  replaced by a longer file, that 0_downloader has not removed yet,
+        #  and the ones after a file not processed yet, so txs are always
+        #  folded in batch order
+        names = list_shards(self.transactions_folder)
+        processed = self.processed_names()
+        contained = set(contained_shards(names, processed))
+        first_new = next((
+            _file for _file in names
+            if _file not in contained and _file not in processed
+        ), None)
+        processed_files = sorted(
+            self.store.processed_files(), key=lambda f: shard_batches(f[0]))
+        for _i, (_file, _size, _mtime, _hash) in enumerate(processed_files):
+            if _file in contained or (
+                first_new and shard_batches(_file) > shard_batches(first_new)
+            ) or self.file_changed(_file, _size, _mtime, _hash):
+                for _rollback_file, *_ in reversed(processed_files[_i:]):
+                    self.rollback(_rollback_file)
+                break
+
+    def rollback(self, name):
+        print(f"Rolling back file: {name}")
+        self.store.rollback_file(name)
+
+    def unknown_addresses(self, txs):
+        # Replays the membership checks of process(), so we get exactly the
+        # 'to' addresses that would need their code retrieved, deduplicated
+        contracts = self.store.contracts
+        no_contracts = self.store.no_contracts
+        known = set()
+        unknown = []
+        for _tx in txs:
+            known.add(_tx.get('from').lower())
+            _contract = _tx.get('receipt').get('contractAddress')
+            if _contract:
+                known.add(_contract.lower())
+                continue
+            _to = _tx.get('to').lower()
+            if _to in known or _to in contracts or _to in no_contracts:
+                continue
+            known.add(_to)
+            unknown.append(_to)
+        return unknown
+
+    def process_files(self, names=None):
+        # Files of the transactions folder (or the ones given) not
+        #  processed yet
+        if names is None:
+            names = list_shards(self.transactions_folder)
+        contained = set(contained_shards(names, self.processed_names()))
+        for _file in names:
+            full_path = os.path.join(self.transactions_folder, _file)
+            if _file in contained:
+                print(f"Skipping file replaced by another one: {full_path}")
+                continue
+            if self.store.is_processed(_file):
+                print(f"Skipping already processed file: {full_path}")
+                continue
+            # Txs are read one at a time, once per pass
+            self.process(_file, lambda: iter_shard(full_path))
+
+    def process(self, name, txs, hash=None):
+        # txs: a function returning the txs of the file, called twice. hash:
+        #  the one of the file if known (taken as it was written)
+        start_time = time()
+        full_path = os.path.join(self.transactions_folder, name)
+        print(f"Processing file: {full_path}")
+        _stat = os.stat(full_path)
+        _hash = hash or file_hash(full_path)
+
+        # Only addresses are kept in memory, contract info and txs are in
+        #  the store
+        store = self.store
+        contracts = store.contracts
+        no_contracts = store.no_contracts
+
+        contracts_hits = 0
+        no_contracts_hits = 0
+        contract_count = 0
+        no_contract_count = 0
+
+        # Get code for all unknown addresses of the file in batches
+        #  (a first pass over the txs)
+        _codes = resolve_contract_codes(self.unknown_addresses(txs()))
+
+        for _tx in txs():
+            _from = _tx.get('from').lower()
+            # The from of a external tx can never be a contract, so we cache
+            #  that
+            store.add_no_contract(_from)
+            no_contract_count += 1
+
+            # tx failed
+            # if _tx.get('status') == '0x0':
+            #     continue
+
+            # We catch direct contract creation here
+            _contract = _tx.get('receipt').get('contractAddress')
+            if _contract:
+                _contract = _contract.lower()
+                store.create_contract(
+                    _contract,
+                    create_tx_hash=_tx.get('hash'),
+                    create_block=_tx.get('blockNumber'),
+                    creator=_tx.get('from'),
+                    input=_tx.get('input'),
+                )
+                contract_count += 1
+
+            else:
+                _to = _tx.get('to').lower()
+                _success = _tx.get('receipt').get('status') == '0x1'
+
+                # Regular execution on contract
+                if _to in contracts:
+                    store.add_tx(_to, _tx.get('hash'), _success)
+                    contracts_hits += 1
+                    continue
+
+                # Already checked and not a contract
+                if _to in no_contracts:
+                    no_contracts_hits += 1
+                    continue
+
+                # Complex cases, code has been retrieved in advance
+                _code = _codes.get(_to)
+                if not _code or _code == '0x':
+                    store.add_no_contract(_to)
+                    no_contract_count += 1
+                else:
+                    store.create_contract(
+                        _to, create_block='UNKNOWN', runtime=_code)
+                    store.add_tx(_to, _tx.get('hash'), _success)
+                    contract_count += 1
+                continue
+
+        total_time = time() - start_time
+        print(
+            f"Processed file: {full_path}, "
+            f"new_contracts: {contract_count}, "
+            f"new_no_contracts: {no_contract_count}, "
+            f"contracts_hits: {contracts_hits}, "
+            f"no_contracts_hits: {no_contracts_hits}, "
+            f"total_contract_count: {len(contracts)}, "
+            f"| Code lookups: {len(_codes)} "
+            f"| Time: {total_time:.2f} seconds"
+        )
+        # Checkpoint after each file, just in case we get killed in between
+        store.checkpoint(name, _stat.st_size, _stat.st_mtime, _hash)
+
+    def finish(self, output_folder):
+        # Add runtime to these addresses than doesnt have it
+        _addresses = self.store.missing_runtimes()
+        _contracts2 = contract_fetcher(_addresses)
+        self.store.set_runtimes(
+            (_contract2.get('address'), _contract2.get('result'))
+            for _contract2 in _contracts2
+        )
+
+        # JSON files are kept as an export, the store is what next steps
+        #  read
+        if cfg.EXPORT_JSON:
+            self.store.export_json(
+                output_folder, cfg.CONTRACTS_FILE, cfg.RUNTIMES_FILE,
+                cfg.NO_CONTRACTS_CACHE)
@@ -1,3 +1,16 @@
+import hashlib
+
+
 def chunks(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
+
+
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def code_hash(runtime):
+    # Key of a runtime in the store, sha256 of the code bytes
+    return '0x' + hashlib.sha256(bytes.fromhex(runtime[2:])).hexdigest()